@@ -8,82 +8,498 @@ import queue
 import asyncio
 from typing import Dict, Tuple, List, Any, Union, DefaultDict
 import hashlib
-from pynvml import nvmlDeviceGetHandleByIndex, nvmlDeviceGetName
+import platform
+import copy
+import inspect
+import threading
 
 
 from tqdm import tqdm
-import vllm
 import torch
+import torch.nn.functional as F
 import transformers
-import mii
-from deepspeed.inference.config import DtypeEnum
-from mii.batching.ragged_batching import *
-from mii.batching.data_classes import Response
+from transformers import StoppingCriteriaList
 from transformers.generation.logits_process import LogitsProcessor, LogitsProcessorList
 
+import continuous_batching
+import results_db
+import stop_sequences
 
-class StopLogitsProcessor(LogitsProcessor):
-    def __init__(self, tokenizer, stop='\n\n\n\n'):
-        self.stop_list = torch.tensor([13, 13, 13, 13]).cuda() # tokenizer.encode(stop, add_special_tokens=False, return_tensors="pt").cuda()
-        self.inf = torch.tensor(1e5).cuda()
-        self.stop_length = len(self.stop_list)
-        self.eos_token_id = tokenizer.eos_token_id
+
+class FirstStepTimer(LogitsProcessor):
+    # The scores of the first new token are ready when the prefill is done.
+    def __init__(self, device):
+        self.device = device
+        self.time = None
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        mask = torch.all(input_ids[:, -self.stop_length:] == self.stop_list, dim=1)
-        scores[:, self.eos_token_id] = torch.where(mask, self.inf, scores[:, self.eos_token_id])
+        if self.time is None:
+            synchronize(self.device)
+            self.time = time.time()
         return scores
 
 
-@torch.no_grad()
-def main(args):
-    random.seed(42)
+class ForwardCounter:
+    # Counts the forward passes of a model with a forward hook.
+    def __init__(self, model):
+        self.count = 0
+        self.handle = model.register_forward_hook(self.hook)
 
-    logging.info("loading data and model...")
+    def hook(self, module, inputs, output):
+        self.count += 1
+
+    def remove(self):
+        self.handle.remove()
+
+
+class TokenizationPipeline:
+    # Producer/consumer around the static batch loop: a background thread
+    # tokenizes the upcoming batches (up to `prefetch` ahead) and another one
+    # detokenizes the finished batches and writes their outputs, so generation
+    # never waits on the tokenizer. Fast tokenizers release the GIL while
+    # encoding and decoding. The detokenizer is a copy of the tokenizer, since
+    # a Rust tokenizer can't be used by two threads at once.
+    def __init__(self, tokenizer, prompts, batches, outputs, prefetch=2, pin_memory=False):
+        self.tokenizer = tokenizer
+        self.detokenizer = copy.deepcopy(tokenizer)
+        self.prompts = prompts
+        self.batches = batches
+        self.outputs = outputs
+        self.pin_memory = pin_memory
+        self.inputs = queue.Queue(maxsize=prefetch)
+        self.finished = queue.Queue()
+        # Busy time of the background threads.
+        self.tokenize_time = 0
+        self.detokenize_time = 0
+        self.token_num = 0
+        self.error = None
+        self.threads = [
+            threading.Thread(target=self.tokenize_worker, daemon=True),
+            threading.Thread(target=self.detokenize_worker, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def tokenize_worker(self):
+        try:
+            for batch in self.batches:
+                start_time = time.time()
+                inputs = self.tokenizer([self.prompts[idx] for idx in batch], add_special_tokens=True, padding=True, truncation=True, return_tensors='pt')
+                input_ids = inputs['input_ids'].pin_memory() if self.pin_memory else inputs['input_ids']
+                self.tokenize_time += time.time() - start_time
+                self.inputs.put(input_ids)
+        except Exception as e:
+            self.inputs.put(e)
+
+    def detokenize_worker(self):
+        while True:
+            item = self.finished.get()
+            if item is None:
+                return
+            batch, new_tokens = item
+            try:
+                start_time = time.time()
+                out_str = self.detokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+                self.token_num += int((new_tokens != self.detokenizer.pad_token_id).sum())
+                for idx, o_str in zip(batch, out_str):
+                    self.outputs[idx] = o_str
+                self.detokenize_time += time.time() - start_time
+            except Exception as e:
+                self.error = e
+
+    def get(self):
+        # Input ids of the next batch, in the order of `batches`.
+        item = self.inputs.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def put(self, batch, new_tokens):
+        self.finished.put((batch, new_tokens))
+
+    def close(self):
+        # Waits for the last batches to be detokenized.
+        self.finished.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def synchronize(device):
+    # Waits for the GPU the model runs on, which may not be the current one.
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def print_phase_times(phase_times, total_time):
+    print('phase times: ' + ', '.join(
+        f'{phase} = {value:.2f} s ({value / total_time:.1%})' for phase, value in phase_times.items()
+    ))
+
+
+def get_batch_order(eval_data, prompt_lengths, args):
+    if args.batch_order == 'dataset':
+        return list(range(len(eval_data)))
+    elif args.batch_order == 'prompt_length':
+        key = lambda idx: prompt_lengths[idx]
+    else:
+        # The expected output length is the `max_tokens` of the example, if any.
+        key = lambda idx: prompt_lengths[idx] + min(eval_data[idx].get('max_tokens', args.max_new_tokens), args.max_new_tokens)
+    # Longest first, so that an out of memory error shows up in the first batch.
+    return sorted(range(len(eval_data)), key=key, reverse=True)
+
+
+def next_bucket(length, buckets):
+    # Prompts longer than the largest bucket keep their own length.
+    for bucket in sorted(buckets):
+        if length <= bucket:
+            return bucket
+    return length
+
+
+def pad_to_bucket(input_ids, pad_token_id, args):
+    # Left-pads the prompts to the next length bucket and repeats the first
+    # prompt up to the next power-of-two batch size, so the compiled model
+    # only sees a few shapes. The extra rows are dropped after generation.
+    batch_size, length = input_ids.shape
+    input_ids = F.pad(input_ids, (next_bucket(length, args.prompt_length_buckets) - length, 0), value=pad_token_id)
+    padded_batch_size = 1 << (batch_size - 1).bit_length()
+    if padded_batch_size > batch_size:
+        input_ids = torch.cat([input_ids, input_ids[:1].expand(padded_batch_size - batch_size, -1)])
+    return input_ids
+
+
+def timed_generate(model, input_ids, generation_kwargs, first_step_timer, stop_criteria):
+    # Returns the output, the total time and the decode time per token.
+    first_step_timer.time = None
+    if stop_criteria is not None:
+        stop_criteria.reset(input_ids.size(1))
+    synchronize(model.device)
+    start_time = time.time()
+    output = model.generate(input_ids, **generation_kwargs)
+    synchronize(model.device)
+    end_time = time.time()
+    decode_steps = max(output.size(1) - input_ids.size(1) - 1, 1)
+    return output, end_time - start_time, (end_time - first_step_timer.time) / decode_steps
+
+
+def warmup_compiled(model, tokenizer, prompts, batches, prompt_lengths, generation_kwargs, first_step_timer, stop_criteria, args):
+    # Compiles the graphs of every padded shape before the timed loop. On the
+    # first batch of each shape, the compilation time is the first compiled
+    # run minus the second one, and the decode time per token of the second
+    # run is compared with an eager run using the default dynamic cache.
+    shapes = {}
+    for batch in batches:
+        length = next_bucket(max(prompt_lengths[idx] for idx in batch), args.prompt_length_buckets)
+        shapes.setdefault((1 << (len(batch) - 1).bit_length(), length), batch)
+    compiled_forward = model.forward
+    eager_kwargs = {key: value for key, value in generation_kwargs.items() if key not in ('cache_implementation', 'disable_compile')}
+    compile_time = eager_latency = compiled_latency = 0
+    for shape, batch in tqdm(shapes.items(), desc='compiling'):
+        inputs = tokenizer([prompts[idx] for idx in batch], add_special_tokens=True, padding=True, truncation=True, return_tensors='pt')
+        input_ids = pad_to_bucket(inputs['input_ids'], tokenizer.pad_token_id, args).to(model.device)
+        _, first_time, _ = timed_generate(model, input_ids, generation_kwargs, first_step_timer, stop_criteria)
+        _, second_time, token_latency = timed_generate(model, input_ids, generation_kwargs, first_step_timer, stop_criteria)
+        compile_time += first_time - second_time
+        compiled_latency += token_latency
+        model.forward = model.eager_forward
+        _, _, token_latency = timed_generate(model, input_ids, eager_kwargs, first_step_timer, stop_criteria)
+        model.forward = compiled_forward
+        eager_latency += token_latency
+    compile_stats = {
+        'compile_time': compile_time,
+        'shapes': [list(shape) for shape in shapes],
+        'eager_decode_token_latency': eager_latency / len(shapes),
+        'compiled_decode_token_latency': compiled_latency / len(shapes),
+    }
+    compile_stats['decode_speedup'] = compile_stats['eager_decode_token_latency'] / compile_stats['compiled_decode_token_latency']
+    print(f'compile time = {compile_time:.2f} s for {len(shapes)} shapes, decode time per token = '
+        f'{compile_stats["compiled_decode_token_latency"] * 1000:.2f} ms compiled vs '
+        f'{compile_stats["eager_decode_token_latency"] * 1000:.2f} ms eager '
+        f'({compile_stats["decode_speedup"]:.2f}x)')
+    return compile_stats
+
+
+def speculative_summary(batch_phase_times):
+    # Every target forward pass verifies the draft tokens and adds one token of
+    # its own, and every draft forward pass proposes one token.
+    new_tokens = sum(batch_times['new_tokens'] for batch_times in batch_phase_times)
+    target_forwards = sum(batch_times['target_forwards'] for batch_times in batch_phase_times)
+    draft_forwards = sum(batch_times['draft_forwards'] for batch_times in batch_phase_times)
+    accepted_tokens = max(new_tokens - target_forwards, 0)
+    return {
+        'target_forwards': target_forwards,
+        'draft_forwards': draft_forwards,
+        'accepted_tokens': accepted_tokens,
+        'acceptance_rate': accepted_tokens / draft_forwards if draft_forwards else None,
+        'tokens_per_target_forward': new_tokens / target_forwards if target_forwards else None,
+    }
+
+
+def speculative_baseline(model, tokenizer, prompts, batches, outputs, generation_kwargs, stop_criteria):
+    # Regenerates the batches without the draft model, end to end as the
+    # serial batch loop. Greedy assisted generation should give the same
+    # outputs. Returns the time and the number of identical outputs.
+    generation_kwargs = {key: value for key, value in generation_kwargs.items() if key != 'assistant_model'}
+    total_time = 0
+    matching_outputs = 0
+    for batch in tqdm(batches, desc='baseline'):
+        start_time = time.time()
+        inputs = tokenizer([prompts[idx] for idx in batch], add_special_tokens=True, padding=True, truncation=True, return_tensors='pt')
+        input_ids = inputs['input_ids'].to(model.device)
+        if stop_criteria is not None:
+            stop_criteria.reset(input_ids.size(1))
+        output = model.generate(input_ids, **generation_kwargs)
+        out_str = tokenizer.batch_decode(output[:, input_ids.size(1):], skip_special_tokens=True)
+        total_time += time.time() - start_time
+        matching_outputs += sum(outputs[idx] == o_str for idx, o_str in zip(batch, out_str))
+    return total_time, matching_outputs
+
+
+def kv_cache_bytes_per_token(config, dtype):
+    num_heads = config.num_attention_heads
+    num_kv_heads = getattr(config, 'num_key_value_heads', None) or num_heads
+    head_dim = getattr(config, 'head_dim', None) or config.hidden_size // num_heads
+    # Keys and values of every layer.
+    return 2 * config.num_hidden_layers * num_kv_heads * head_dim * torch.tensor([], dtype=dtype).element_size()
+
+
+def get_token_budget(model, args):
+    if args.batch_token_budget != 'auto':
+        return int(args.batch_token_budget)
+    if model.device.type == 'cuda':
+        free_memory, _ = torch.cuda.mem_get_info(model.device)
+    else:
+        free_memory = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    return int(free_memory * args.kv_cache_memory_fraction / kv_cache_bytes_per_token(model.config, model.dtype))
+
+
+def token_budget_batches(order, prompt_lengths, budget, args):
+    # Greedy packing in the given order. A batch is padded to its longest
+    # prompt and may run for `max_new_tokens`, so it costs
+    # batch size x (longest prompt + max_new_tokens) tokens of KV cache.
+    batches = []
+    batch, max_prompt_length = [], 0
+    for idx in order:
+        length = max(max_prompt_length, prompt_lengths[idx])
+        if batch and (len(batch) + 1) * (length + args.max_new_tokens) > budget:
+            batches.append(batch)
+            batch, length = [], prompt_lengths[idx]
+        batch.append(idx)
+        max_prompt_length = length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def padding_waste(lengths, batches):
+    # Fraction of the padded batch slots holding pad tokens.
+    padded = sum(len(batch) * max(lengths[idx] for idx in batch) for batch in batches)
+    return 1 - sum(lengths[idx] for batch in batches for idx in batch) / padded
+
+
+def load_data(args):
     if args.data_path is None:
         raise ValueError
     with open(args.data_path, 'r') as f:
-        eval_data = json.load(f)
-    dataset_name = os.path.split(args.data_path)[-1]
+        return json.load(f)
 
+
+def load_tokenizer(args):
     if 'Llama-2' in args.model_name_or_path:
-        prompts = [example['prompt'] for example in eval_data]
         tokenizer = transformers.AutoTokenizer.from_pretrained(args.model_name_or_path, padding_side="left")
         tokenizer.pad_token = tokenizer.unk_token
         tokenizer.pad_token_id = tokenizer.unk_token_id
-        print(prompts[0])
     elif 'vicuna' in args.model_name_or_path:
-        prompts = [example['prompt'] for example in eval_data]
         tokenizer = transformers.AutoTokenizer.from_pretrained(args.model_name_or_path, padding_side="left")
         # tokenizer.pad_token = tokenizer.unk_token
         # tokenizer.pad_token_id = tokenizer.unk_token_id
-        print(prompts[0])
     else:
         raise NotImplementedError
+    return tokenizer
+
 
+def setup_device(args):
+    # Falls back to CPU when no GPU is visible. vLLM and MII only run on GPU.
+    if args.device.startswith('cuda') and not torch.cuda.is_available():
+        if args.backend != 'transformers':
+            raise ValueError(f'The {args.backend} backend needs a GPU.')
+        print(f'No GPU is available, the transformers backend runs on CPU instead of {args.device}.')
+        args.device = 'cpu'
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+
+def apply_speculative_args(args):
+    # Assisted generation of transformers runs one sequence per batch. The
+    # arguments are changed in place, so that the batch size that is actually
+    # used is the one reported and saved.
+    if args.assistant_model is None or args.backend != 'transformers':
+        return
+    if args.continuous_batching or args.compile:
+        raise ValueError('`assistant_model` is only supported by the eager static batch loop.')
+    if args.eval_batch_size != 1 or args.batch_token_budget is not None:
+        print('Assisted generation only supports batches of one sequence, `eval_batch_size` is set to 1.')
+        args.eval_batch_size = 1
+        args.batch_token_budget = None
+
+
+def load_model(args):
+    # Returns the model, the draft model of assisted generation (transformers
+    # backend with `assistant_model`, None otherwise) and their load time. The
+    # MII backend returns its pipeline with `persistent_pipeline` and None
+    # otherwise, every batch then loads its own.
+    load_start_time = time.time()
+    assistant_model = None
     if args.backend == 'vllm':
+        import vllm
+        llm_kwargs = {}
+        if args.assistant_model is not None:
+            # The draft model option was renamed across vLLM versions.
+            engine_args = inspect.signature(vllm.EngineArgs).parameters
+            if 'speculative_config' in engine_args:
+                llm_kwargs['speculative_config'] = {
+                    'model': args.assistant_model,
+                    'num_speculative_tokens': args.num_assistant_tokens,
+                }
+            elif 'speculative_model' in engine_args:
+                llm_kwargs['speculative_model'] = args.assistant_model
+                llm_kwargs['num_speculative_tokens'] = args.num_assistant_tokens
+                if 'use_v2_block_manager' in engine_args:
+                    llm_kwargs['use_v2_block_manager'] = True
+            else:
+                raise ValueError(f'vLLM {vllm.__version__} has no speculative decoding.')
+        if args.vllm_max_num_seqs is not None:
+            llm_kwargs['max_num_seqs'] = args.vllm_max_num_seqs
         model = vllm.LLM(
             model=args.model_name_or_path,
-            dtype=torch.bfloat16,
+            dtype=getattr(torch, args.dtype),
             tokenizer=args.model_name_or_path,
             tensor_parallel_size=1,
+            **llm_kwargs,
         )
+    elif args.backend == 'mii':
+        if args.assistant_model is not None:
+            raise ValueError('The mii backend has no speculative decoding.')
+        model = load_mii_pipeline(args) if args.persistent_pipeline else None
+    else:
+        model = transformers.AutoModelForCausalLM.from_pretrained(
+            args.model_name_or_path, torch_dtype=getattr(torch, args.dtype)
+        ).eval().to(args.device)
+        if args.assistant_model is not None:
+            # The draft model must share the tokenizer of the target model.
+            assistant_model = transformers.AutoModelForCausalLM.from_pretrained(
+                args.assistant_model, torch_dtype=getattr(torch, args.dtype)
+            ).eval().to(args.device)
+            assistant_model.generation_config.num_assistant_tokens = args.num_assistant_tokens
+            assistant_model.generation_config.num_assistant_tokens_schedule = args.num_assistant_tokens_schedule
+            if args.assistant_confidence_threshold is not None:
+                assistant_model.generation_config.assistant_confidence_threshold = args.assistant_confidence_threshold
+    return model, assistant_model, time.time() - load_start_time
+
+
+def load_mii_pipeline(args):
+    import mii
+    max_length = 4096 if 'llama2' in args.model_name_or_path else 16383
+    return mii.pipeline(args.model_name_or_path, max_length=max_length, torch_dist_port=11454)
+
+
+def unload_model(model, args):
+    if args.backend == 'mii' and model is not None:
+        model.destroy()
+    elif args.backend == 'vllm':
+        # Releases the distributed state, so that another engine can be built
+        # in the same process.
+        try:
+            from vllm.distributed.parallel_state import destroy_model_parallel
+            destroy_model_parallel()
+        except ImportError:
+            pass
+
+
+def get_cpu_model():
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def get_gpu_name(args):
+    # NVML ignores CUDA_VISIBLE_DEVICES, so the visible index is mapped to the
+    # physical one. Without NVML (or with UUIDs in CUDA_VISIBLE_DEVICES) the
+    # name comes from PyTorch.
+    index = torch.device(args.device).index or 0
+    try:
+        from pynvml import nvmlInit, nvmlDeviceGetHandleByIndex, nvmlDeviceGetName
+        visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+        if visible is not None:
+            index = int(visible.split(',')[index])
+        nvmlInit()
+        name = nvmlDeviceGetName(nvmlDeviceGetHandleByIndex(index))
+        return name.decode() if isinstance(name, bytes) else name
+    except Exception as e:
+        print(f'NVML is not available ({e!r}), the device name is read from PyTorch.')
+        return torch.cuda.get_device_name(torch.device(args.device))
+
+
+def get_hardware_info(args):
+    # `device` is the GPU name, or the CPU model when running on CPU.
+    cpu_model = get_cpu_model()
+    return {
+        'device': get_gpu_name(args) if args.device.startswith('cuda') else cpu_model,
+        'device_type': torch.device(args.device).type,
+        'dtype': args.dtype,
+        'cpu_model': cpu_model,
+        'cpu_cores': os.cpu_count(),
+        'available_cores': len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count(),
+        'num_threads': torch.get_num_threads(),
+    }
+
+
+@torch.no_grad()
+def generate(model, tokenizer, prompts, eval_data, args, assistant_model=None):
+    # Runs the whole dataset through a loaded model. Returns the outputs in
+    # dataset order with the timings and statistics of the run.
+    stop_strings = stop_sequences.parse_stop_strings(args.stop)
+    if args.remove_row_delimiter:
+        stop_strings.append('\n\n\n\n')
+    stop_stats = {}
+    padding_stats = {}
+    batch_stats = {}
+    # Only the transformers backend is broken down, vLLM and MII tokenize and
+    # schedule inside their generate call.
+    phase_times = {}
+    batch_phase_times = []
+    overlap_stats = {}
+    compile_stats = {}
+    speculative_stats = {}
+    # Load time spent during generation, by the per-batch MII pipelines.
+    load_time = 0
+    if args.backend == 'vllm':
+        import vllm
         sampling_kwargs = dict(
             temperature=0,  # greedy decoding
             max_tokens=args.max_new_tokens,
         )
-        if args.remove_row_delimiter:
-            sampling_kwargs['stop'] = '\n\n\n\n'
+        if stop_strings:
+            sampling_kwargs['stop'] = stop_strings
         if args.ignore_eos:
             sampling_kwargs['ignore_eos'] = True
         sampling_params = vllm.SamplingParams(**sampling_kwargs)
+        if args.assistant_model is not None:
+            # vLLM reports the draft acceptance in its logs, the speedup is
+            # measured against a run without `assistant_model`.
+            speculative_stats.update(assistant_model=args.assistant_model, num_speculative_tokens=args.num_assistant_tokens)
 
         start_time = time.time()
         out = model.generate(prompts, sampling_params=sampling_params)
         end_time = time.time()
         total_time = end_time - start_time
-        print(f'total_time = {total_time}')
-        print(f'sequence num = {len(prompts)}')
         total_token_num = 0
         outputs = []
         for it in out:
@@ -91,10 +507,7 @@ def main(args):
             outputs.append(
                 it.outputs[0].text
             )
-        print(f'generated tokens num = {total_token_num}')
     elif args.backend == 'mii':
-        max_length = 4096 if 'llama2' in args.model_name_or_path else 16383
-        # pipe = mii.pipeline(args.model_name_or_path, max_length=max_length, torch_dist_port=11454)
         total_time = 0
         total_token_num = 0
         outputs = []
@@ -105,24 +518,28 @@ def main(args):
         if args.ignore_eos:
             pipe_kwargs['ignore_eos'] = True
             # pipe_kwargs['stop'] = -1
+        # By default every batch gets a freshly loaded pipeline (cold caches),
+        # with `persistent_pipeline` the model is loaded once for all batches.
         for i in tqdm(range(0, len(prompts), args.eval_batch_size)):
-            pipe = mii.pipeline(args.model_name_or_path, max_length=max_length, torch_dist_port=11454)
+            if model is None:
+                load_start_time = time.time()
+                pipe = load_mii_pipeline(args)
+                load_time += time.time() - load_start_time
+            else:
+                pipe = model
             start_time = time.time()
             out = pipe(prompts[i:i + args.eval_batch_size], **pipe_kwargs)
             end_time = time.time()
-            pipe.destroy()
-            del pipe
+            if model is None:
+                pipe.destroy()
+                del pipe
             total_time += end_time - start_time
             # print(len(out))
             for it in out:
                 total_token_num += it.generated_length
                 outputs.append(it.generated_text)
             # break
-        print(f'total_time = {total_time}')
-        print(f'sequence num = {len(prompts)}')
-        print(f'generated tokens num = {total_token_num}')
     else:
-        model = transformers.AutoModelForCausalLM.from_pretrained(args.model_name_or_path, torch_dtype=torch.bfloat16).eval().cuda()
         total_time = 0
         total_token_num = 0
         outputs = []
@@ -130,40 +547,273 @@ def main(args):
             max_new_tokens=args.max_new_tokens,
             do_sample=False
         )
-        if args.remove_row_delimiter:
-            processors = LogitsProcessorList()
-            processors.append(StopLogitsProcessor(tokenizer, '\n\n\n\n'))
-            generation_kwargs['logits_processor'] = processors
+        first_step_timer = FirstStepTimer(model.device)
+        processors = LogitsProcessorList([first_step_timer])
+        stop_patterns = stop_sequences.build_stop_patterns(tokenizer, stop_strings)
+        stop_criteria = None
+        if stop_patterns:
+            print(f'stop patterns = {stop_patterns}')
+            stop_stats.update(patterns=stop_patterns, stopped_sequences=0, tokens_saved=0)
+            matcher = stop_sequences.StopSequenceMatcher(stop_patterns)
+            if stop_sequences.PER_SEQUENCE_STOPPING:
+                stop_criteria = stop_sequences.StopSequenceCriteria(matcher)
+                generation_kwargs['stopping_criteria'] = StoppingCriteriaList([stop_criteria])
+            else:
+                processors.append(stop_sequences.StopSequenceLogitsProcessor(matcher, tokenizer.eos_token_id))
+        generation_kwargs['logits_processor'] = processors
         if args.ignore_eos:
             generation_kwargs['eos_token_id'] = -1
-        for i in tqdm(range(0, len(prompts), args.eval_batch_size)):
+        if args.compile:
+            if args.continuous_batching:
+                raise ValueError('`compile` is only supported by the static batch loop.')
+            # The forward pass (prefill and decode) is compiled once per padded
+            # shape and runs on a preallocated static KV cache. Recent versions
+            # of transformers would compile the decode step again on their own.
+            generation_kwargs['cache_implementation'] = 'static'
+            if hasattr(transformers.GenerationConfig(), 'disable_compile'):
+                generation_kwargs['disable_compile'] = True
+            model.eager_forward = model.forward
+            model.forward = torch.compile(model.eager_forward, mode=args.compile_mode, dynamic=False)
+        speculative = assistant_model is not None
+        if speculative:
+            if args.eval_batch_size != 1 or args.batch_token_budget is not None:
+                raise ValueError('Call `apply_speculative_args` before generating with a draft model.')
+            generation_kwargs['assistant_model'] = assistant_model
+            target_counter = ForwardCounter(model)
+            draft_counter = ForwardCounter(assistant_model)
+        prompt_lengths = list(map(len, tokenizer(prompts, add_special_tokens=True)['input_ids']))
+        order = get_batch_order(eval_data, prompt_lengths, args)
+        # Outputs are written back at the position of their prompt in the dataset.
+        outputs = [None] * len(prompts)
+        if args.continuous_batching:
+            engine = continuous_batching.ContinuousBatchingEngine(
+                model,
+                pad_token_id=tokenizer.pad_token_id,
+                eos_token_id=None if args.ignore_eos else tokenizer.eos_token_id,
+                max_batch_size=args.eval_batch_size,
+                max_batch_tokens=None if args.batch_token_budget is None else get_token_budget(model, args),
+                stop_token_ids=stop_patterns,
+            )
             start_time = time.time()
-            inputs = tokenizer(prompts[i:i + args.eval_batch_size], add_special_tokens=True, padding=True, truncation=True, return_tensors='pt')
-            input_ids = inputs['input_ids'].cuda()
-            output = model.generate(input_ids, **generation_kwargs)
-            out_str = tokenizer.batch_decode(output[:, input_ids.size(1):], skip_special_tokens=True)
+            prompts_ids = tokenizer([prompts[idx] for idx in order], add_special_tokens=True, truncation=True)['input_ids']
+            tokenize_end_time = time.time()
+            output_ids, engine_stats = engine.generate(prompts_ids, args.max_new_tokens)
+            generate_end_time = time.time()
+            out_str = tokenizer.batch_decode(output_ids, skip_special_tokens=True)
             end_time = time.time()
-            total_time += end_time - start_time
-            token_num = int((output[:, input_ids.size(1):] != tokenizer.pad_token_id).sum().cpu())
-            total_token_num += token_num
-            for prompt, o_str in zip(prompts[i:i + args.eval_batch_size], out_str):
-                outputs.append(o_str)
-        print(f'total_time = {total_time}')
-        print(f'sequence num = {len(prompts)}')
-        print(f'generated tokens num = {total_token_num}')
-
-    handle = nvmlDeviceGetHandleByIndex(int(os.environ.get('CUDA_VISIBLE_DEVICES', '0')))
-    device_name = nvmlDeviceGetName(handle)
+            total_time = end_time - start_time
+            phase_times = {
+                'tokenize': tokenize_end_time - start_time,
+                'prefill': engine_stats.pop('prefill_time'),
+                'decode': engine_stats.pop('decode_time'),
+                'schedule': engine_stats.pop('schedule_time'),
+                'detokenize': end_time - generate_end_time,
+            }
+            total_token_num = sum(map(len, output_ids))
+            for idx, o_str in zip(order, out_str):
+                outputs[idx] = o_str
+            if stop_patterns:
+                stop_stats['stopped_sequences'] = engine_stats.pop('stopped_sequences')
+                stop_stats['tokens_saved'] = engine_stats.pop('tokens_saved')
+            batch_stats.update(engine_stats)
+            print(f'{engine_stats["prefill_steps"]} prefill steps, {engine_stats["decode_steps"]} decode steps '
+                f'with {engine_stats["avg_decode_batch_size"]:.1f} sequences on average')
+        else:
+            if args.batch_token_budget is not None:
+                token_budget = get_token_budget(model, args)
+                batches = token_budget_batches(order, prompt_lengths, token_budget, args)
+                print(f'token budget = {token_budget} '
+                    f'({kv_cache_bytes_per_token(model.config, model.dtype) / 1024:.0f} KiB of KV cache per token), '
+                    f'{len(batches)} batches of {len(prompts) / len(batches):.1f} sequences on average')
+                batch_stats['token_budget'] = token_budget
+            else:
+                batches = [order[i:i + args.eval_batch_size] for i in range(0, len(order), args.eval_batch_size)]
+            batch_stats['num_batches'] = len(batches)
+            batch_stats['max_batch_size'] = max(map(len, batches))
+            dataset_batches = [
+                list(range(i, min(i + args.eval_batch_size, len(prompts))))
+                for i in range(0, len(prompts), args.eval_batch_size)
+            ]
+            padding_stats['prompt_dataset_order'] = padding_waste(prompt_lengths, dataset_batches)
+            padding_stats['prompt'] = padding_waste(prompt_lengths, batches)
+            decode_slots = 0
+            phase_times = {'tokenize': 0, 'prefill': 0, 'decode': 0, 'detokenize': 0}
+            if args.compile:
+                compile_stats.update(warmup_compiled(
+                    model, tokenizer, prompts, batches, prompt_lengths, generation_kwargs, first_step_timer, stop_criteria, args
+                ))
+            # With `overlap_tokenization` the tokenize and detokenize phases
+            # are the time the batch loop waits on the background threads.
+            pipeline = None
+            if args.overlap_tokenization:
+                pipeline = TokenizationPipeline(
+                    tokenizer, prompts, batches, outputs,
+                    prefetch=args.prefetch_batches, pin_memory=model.device.type == 'cuda',
+                )
+            for batch in tqdm(batches):
+                start_time = time.time()
+                if pipeline is None:
+                    inputs = tokenizer([prompts[idx] for idx in batch], add_special_tokens=True, padding=True, truncation=True, return_tensors='pt')
+                    input_ids = inputs['input_ids'].to(model.device)
+                else:
+                    input_ids = pipeline.get().to(model.device, non_blocking=True)
+                if args.compile:
+                    input_ids = pad_to_bucket(input_ids, tokenizer.pad_token_id, args)
+                synchronize(model.device)
+                tokenize_end_time = time.time()
+                first_step_timer.time = None
+                if stop_criteria is not None:
+                    stop_criteria.reset(input_ids.size(1))
+                if speculative:
+                    target_counter.count = draft_counter.count = 0
+                output = model.generate(input_ids, **generation_kwargs)[:len(batch)]
+                synchronize(model.device)
+                generate_end_time = time.time()
+                if pipeline is None:
+                    out_str = tokenizer.batch_decode(output[:, input_ids.size(1):], skip_special_tokens=True)
+                else:
+                    pipeline.put(batch, output[:, input_ids.size(1):].cpu())
+                end_time = time.time()
+                total_time += end_time - start_time
+                batch_times = {
+                    'batch_size': len(batch),
+                    'prompt_length': input_ids.size(1),
+                    'new_tokens': output.size(1) - input_ids.size(1),
+                    'tokenize': tokenize_end_time - start_time,
+                    'prefill': first_step_timer.time - tokenize_end_time,
+                    'decode': generate_end_time - first_step_timer.time,
+                    'detokenize': end_time - generate_end_time,
+                }
+                if speculative:
+                    batch_times.update(target_forwards=target_counter.count, draft_forwards=draft_counter.count)
+                batch_phase_times.append(batch_times)
+                for phase in phase_times:
+                    phase_times[phase] += batch_times[phase]
+                if stop_criteria is not None and stop_criteria.stop_length is not None:
+                    stop_length = stop_criteria.stop_length[:len(batch)]
+                    stop_length = stop_length[stop_length >= 0]
+                    stop_stats['stopped_sequences'] += len(stop_length)
+                    stop_stats['tokens_saved'] += int((args.max_new_tokens - stop_length).sum())
+                decode_slots += output.size(0) * (output.size(1) - input_ids.size(1))
+                if pipeline is None:
+                    token_num = int((output[:, input_ids.size(1):] != tokenizer.pad_token_id).sum().cpu())
+                    total_token_num += token_num
+                    for idx, o_str in zip(batch, out_str):
+                        outputs[idx] = o_str
+            if pipeline is not None:
+                close_start_time = time.time()
+                pipeline.close()
+                close_time = time.time() - close_start_time
+                total_time += close_time
+                phase_times['detokenize'] += close_time
+                total_token_num = pipeline.token_num
+                critical_time = phase_times['tokenize'] + phase_times['detokenize']
+                overlap_stats.update(
+                    tokenize_worker=pipeline.tokenize_time,
+                    detokenize_worker=pipeline.detokenize_time,
+                    critical_path=critical_time,
+                    hidden=pipeline.tokenize_time + pipeline.detokenize_time - critical_time,
+                )
+                print(f'tokenizer work = {pipeline.tokenize_time + pipeline.detokenize_time:.2f} s in background threads, '
+                    f'{critical_time:.2f} s on the critical path of the batch loop')
+            decode_steps = sum(max(batch_times['new_tokens'] - 1, 0) for batch_times in batch_phase_times)
+            batch_stats['decode_token_latency'] = phase_times['decode'] / decode_steps if decode_steps else None
+            if args.compile:
+                del model.forward
+                del model.eager_forward
+            if speculative:
+                target_counter.remove()
+                draft_counter.remove()
+                speculative_stats.update(
+                    assistant_model=args.assistant_model,
+                    num_assistant_tokens=args.num_assistant_tokens,
+                    num_assistant_tokens_schedule=args.num_assistant_tokens_schedule,
+                    **speculative_summary(batch_phase_times),
+                )
+                baseline_time, matching_outputs = speculative_baseline(
+                    model, tokenizer, prompts, batches, outputs, generation_kwargs, stop_criteria
+                )
+                speculative_stats.update(
+                    baseline_time=baseline_time,
+                    speedup=baseline_time / total_time,
+                    matching_outputs=matching_outputs,
+                )
+                print(f'draft acceptance rate = {speculative_stats["acceptance_rate"]:.2%}, '
+                    f'{speculative_stats["tokens_per_target_forward"]:.2f} tokens per target forward pass, '
+                    f'speedup = {speculative_stats["speedup"]:.2f}x over {baseline_time:.2f} s without the draft model, '
+                    f'{matching_outputs} / {len(prompts)} identical outputs')
+            # Sequences that finish early keep decoding pad tokens until the
+            # longest generation of their batch is done.
+            padding_stats['decode'] = 1 - total_token_num / decode_slots if decode_slots else 0.0
+            print(f'prompt padding waste = {padding_stats["prompt_dataset_order"]:.2%} in dataset order, '
+                f'{padding_stats["prompt"]:.2%} in {args.batch_order} order')
+            print(f'decode padding waste = {padding_stats["decode"]:.2%}')
+        if stop_stats:
+            print(f'{stop_stats["stopped_sequences"]} sequences ended on a stop sequence, '
+                f'{stop_stats["tokens_saved"]} tokens saved compared with generating max_new_tokens')
+        print_phase_times(phase_times, total_time)
+    return {
+        'load_time': load_time,
+        'total_time': total_time,
+        'total_token_num': total_token_num,
+        'outputs': outputs,
+        'padding_stats': padding_stats,
+        'batch_stats': batch_stats,
+        'phase_times': phase_times,
+        'batch_phase_times': batch_phase_times,
+        'stop_stats': stop_stats,
+        'overlap_stats': overlap_stats,
+        'compile_stats': compile_stats,
+        'speculative_stats': speculative_stats,
+    }
+
+
+@torch.no_grad()
+def main(args):
+    random.seed(42)
+
+    logging.info("loading data and model...")
+    eval_data = load_data(args)
+    dataset_name = os.path.split(args.data_path)[-1]
+    prompts = [example['prompt'] for example in eval_data]
+    tokenizer = load_tokenizer(args)
+    print(prompts[0])
+
+    setup_device(args)
+    apply_speculative_args(args)
+    model, assistant_model, load_time = load_model(args)
+    run = generate(model, tokenizer, prompts, eval_data, args, assistant_model)
+    unload_model(model, args)
+    load_time += run['load_time']
+    total_time = run['total_time']
+    total_token_num = run['total_token_num']
+    print(f'load_time = {load_time}')
+    print(f'total_time = {total_time}')
+    print(f'sequence num = {len(prompts)}')
+    print(f'generated tokens num = {total_token_num}')
+
+    hardware = get_hardware_info(args)
+    device_name = hardware['device']
     result = {
         'backend': args.backend,
         'dataset': dataset_name,
         'device': device_name,
+        'hardware': hardware,
+        'load_time': load_time,
         'total_time': total_time,
         'sequence_num': len(prompts),
         'generated_tokens_num': total_token_num,
+        'padding_waste': run['padding_stats'],
+        'batches': run['batch_stats'],
+        'phase_times': run['phase_times'],
+        'stop': run['stop_stats'],
+        'tokenization_overlap': run['overlap_stats'],
+        'compile': run['compile_stats'],
+        'speculative': run['speculative_stats'],
+        'batch_phase_times': run['batch_phase_times'],
         'result': [],
     }
-    for prompt, output in zip(prompts, outputs):
+    for prompt, output in zip(prompts, run['outputs']):
         result['result'].append({
             'prompt': prompt,
             'output': output,
@@ -174,9 +824,31 @@ def main(args):
     with open(output_file, 'w') as f:
         f.write(json_str)
 
+    if args.results_db:
+        run_id = results_db.save_run(
+            args.results_db, 'batching',
+            {
+                'backend': args.backend,
+                'model': args.model_name_or_path,
+                'dataset': dataset_name,
+                'device': device_name,
+                'output_file': output_file,
+                'args': vars(args),
+            },
+            [
+                ('warm', 0, {
+                    'load_time': load_time,
+                    'total_time': total_time,
+                    'sequence_throughput': len(prompts) / total_time,
+                    'generated_tokens': total_token_num,
+                    'token_throughput': total_token_num / total_time,
+                }),
+            ],
+        )
+        print(f'The run is recorded in {args.results_db} with run_id {run_id}')
 
-if __name__ == '__main__':
-    assert len(os.environ.get('CUDA_VISIBLE_DEVICES', '0').split(',')) == 1
+
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--data_path",
@@ -208,16 +880,156 @@ if __name__ == '__main__':
         default="transformers",
         choices=["transformers", "vllm", "mii"]
     )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda",
+        help="Device of the transformers backend, e.g. `cuda`, `cuda:1` or `cpu`. "
+            "Falls back to `cpu` when no GPU is available.",
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=None,
+        help="If specified, number of threads PyTorch uses on CPU.",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="bfloat16",
+        choices=["bfloat16", "float16", "float32"],
+        help="Data type of the model weights. Use `float32` on CPUs without fast bfloat16 support.",
+    )
     parser.add_argument(
         "--remove_row_delimiter",
         action="store_true",
         help="If given, we will remove row delimiter repeated four times.",
     )
+    parser.add_argument(
+        "--stop",
+        type=str,
+        action="append",
+        default=[],
+        help="Stop string, may be repeated. Escapes such as `\\n` are decoded. "
+            "The vLLM and transformers backends stop a sequence when it generates one of them.",
+    )
     parser.add_argument(
         "--ignore_eos",
         action="store_true",
         help="If given, we will continue generating tokens after the EOS token is generated.",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--batch_order",
+        type=str,
+        default="dataset",
+        choices=["dataset", "prompt_length", "total_length"],
+        help="Order in which the transformers backend forms its batches. `prompt_length` sorts the prompts by token "
+            "length, `total_length` adds the expected output length (`max_tokens` of the example). "
+            "The outputs are saved in dataset order in any case.",
+    )
+    parser.add_argument(
+        "--continuous_batching",
+        action="store_true",
+        help="If given, the transformers backend schedules sequences at the iteration level: finished sequences "
+            "leave the batch after every decode step and waiting prompts take their slots. "
+            "`eval_batch_size` is then the maximum number of running sequences.",
+    )
+    parser.add_argument(
+        "--overlap_tokenization",
+        action="store_true",
+        help="If given, the static batch loop of the transformers backend tokenizes the upcoming batches and "
+            "detokenizes the finished ones in background threads, off the critical path of generation.",
+    )
+    parser.add_argument(
+        "--prefetch_batches",
+        type=int,
+        default=2,
+        help="Number of batches tokenized ahead with `--overlap_tokenization`.",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="If given, the static batch loop of the transformers backend generates with a static KV cache and a "
+            "forward pass compiled with `torch.compile`. Prompts are padded to length buckets and batches to "
+            "power-of-two sizes, and every shape is compiled before the timed loop.",
+    )
+    parser.add_argument(
+        "--compile_mode",
+        type=str,
+        default="reduce-overhead",
+        choices=["default", "reduce-overhead", "max-autotune"],
+        help="Mode of `torch.compile` with `--compile`. `reduce-overhead` uses CUDA graphs on GPU.",
+    )
+    parser.add_argument(
+        "--prompt_length_buckets",
+        type=int,
+        nargs="+",
+        default=[32, 64, 128, 256, 512, 1024, 2048, 4096],
+        help="Prompt lengths the batches are padded to with `--compile`.",
+    )
+    parser.add_argument(
+        "--assistant_model",
+        type=str,
+        default=None,
+        help="If specified, draft model of speculative decoding, sharing the tokenizer of the model. The transformers "
+            "backend uses assisted generation (one sequence per batch) and the vLLM backend its speculative config.",
+    )
+    parser.add_argument(
+        "--num_assistant_tokens",
+        type=int,
+        default=5,
+        help="Number of draft tokens proposed per target forward pass with `--assistant_model`.",
+    )
+    parser.add_argument(
+        "--num_assistant_tokens_schedule",
+        type=str,
+        default="constant",
+        choices=["constant", "heuristic", "heuristic_transient"],
+        help="How the transformers backend adapts the number of draft tokens with `--assistant_model`.",
+    )
+    parser.add_argument(
+        "--assistant_confidence_threshold",
+        type=float,
+        default=None,
+        help="If specified, the draft stops proposing tokens below this probability (transformers >= 4.45). "
+            "0 always proposes `num_assistant_tokens` tokens.",
+    )
+    parser.add_argument(
+        "--batch_token_budget",
+        type=str,
+        default=None,
+        help="If specified, the transformers backend forms batches of up to this many KV cache tokens, "
+            "counted as batch size x (longest prompt + max_new_tokens), instead of `eval_batch_size` sequences. "
+            "`auto` derives the budget from the free device memory and the KV cache size of the model.",
+    )
+    parser.add_argument(
+        "--kv_cache_memory_fraction",
+        type=float,
+        default=0.8,
+        help="Fraction of the free device memory given to the KV cache with `--batch_token_budget auto`."
+    )
+    parser.add_argument(
+        "--vllm_max_num_seqs",
+        type=int,
+        default=None,
+        help="If specified, maximum number of sequences the vLLM engine runs together (`max_num_seqs`). "
+            "vLLM otherwise schedules the whole dataset with its default limit and ignores `eval_batch_size`.",
+    )
+    parser.add_argument(
+        "--persistent_pipeline",
+        action="store_true",
+        help="If given, the MII pipeline is loaded once and reused for all batches instead of once per batch.",
+    )
+    parser.add_argument(
+        "--results_db",
+        type=str,
+        default="output/results.db",
+        help="SQLite database the run is recorded in. Pass an empty string to disable.",
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
 
     main(args)
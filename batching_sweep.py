@@ -0,0 +1,197 @@
+import os
+import copy
+import csv
+import gc
+import hashlib
+import io
+import math
+import resource
+
+import torch
+
+import batching_inference
+import results_db
+
+
+# Throughput curves over batch sizes, max_new_tokens and datasets from a single
+# process: the model of every backend is loaded once and reused for the whole
+# grid, instead of relaunching batching_inference.py for every configuration.
+# vLLM fixes its batch size (`max_num_seqs`) and captures its CUDA graphs for
+# it when the engine is built, so its engine is rebuilt for every batch size.
+COLUMNS = [
+    'backend', 'device', 'dataset', 'batch_size', 'max_new_tokens', 'sequence_num', 'generated_tokens', 'total_time',
+    'sequence_throughput', 'token_throughput', 'num_batches', 'batch_latency', 'peak_memory_gb',
+    'acceptance_rate', 'tokens_per_target_forward', 'speculative_speedup',
+]
+
+
+def reset_peak_memory(args):
+    if args.device.startswith('cuda'):
+        torch.cuda.reset_peak_memory_stats(args.device)
+
+
+def peak_memory_gb(args):
+    # Peak memory allocated by PyTorch on the GPU, or the peak resident set
+    # size of the process on CPU (which can't be reset between points).
+    if args.device.startswith('cuda'):
+        return torch.cuda.max_memory_allocated(args.device) / 1024 ** 3
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+
+
+def run_point(model, assistant_model, tokenizer, eval_data, dataset_name, device_name, args):
+    prompts = [example['prompt'] for example in eval_data]
+    batch_size = args.eval_batch_size
+    reset_peak_memory(args)
+    run = batching_inference.generate(model, tokenizer, prompts, eval_data, args, assistant_model)
+    total_time = run['total_time']
+    # vLLM runs the whole dataset at once, at most `batch_size` sequences at a time.
+    num_batches = run['batch_stats'].get('num_batches') or math.ceil(len(prompts) / batch_size)
+    return {
+        'backend': args.backend,
+        'device': device_name,
+        'dataset': dataset_name,
+        'batch_size': batch_size,
+        'max_new_tokens': args.max_new_tokens,
+        'sequence_num': len(prompts),
+        'generated_tokens': run['total_token_num'],
+        'total_time': total_time,
+        'sequence_throughput': len(prompts) / total_time,
+        'token_throughput': run['total_token_num'] / total_time,
+        'num_batches': num_batches,
+        'batch_latency': total_time / num_batches,
+        'peak_memory_gb': peak_memory_gb(args),
+        # Only filled with `--assistant_model` on the transformers backend.
+        'acceptance_rate': run['speculative_stats'].get('acceptance_rate'),
+        'tokens_per_target_forward': run['speculative_stats'].get('tokens_per_target_forward'),
+        'speculative_speedup': run['speculative_stats'].get('speedup'),
+    }
+
+
+def main(args):
+    backends = args.backends or [args.backend]
+    data_paths = args.data_paths or [args.data_path]
+    batch_sizes = args.batch_sizes or [args.eval_batch_size]
+    max_new_tokens_list = args.max_new_tokens_list or [args.max_new_tokens]
+    datasets = []
+    for data_path in data_paths:
+        args.data_path = data_path
+        datasets.append((os.path.split(data_path)[-1], batching_inference.load_data(args)))
+    tokenizer = batching_inference.load_tokenizer(args)
+
+    rows = []
+    for backend in backends:
+        backend_args = copy.deepcopy(args)
+        backend_args.backend = backend
+        # Reloading the MII pipeline for every batch would defeat the sweep.
+        backend_args.persistent_pipeline = True
+        batching_inference.setup_device(backend_args)
+        device_name = batching_inference.get_hardware_info(backend_args)['device']
+        backend_batch_sizes = batch_sizes
+        if backend == 'transformers' and args.assistant_model is not None:
+            # Assisted generation runs one sequence per batch, other batch
+            # sizes would repeat the same point.
+            print('Assisted generation only supports batches of one sequence, the transformers points use batch size 1.')
+            backend_batch_sizes = [1]
+        # Batch sizes sharing one loaded model.
+        if backend == 'vllm':
+            print('vLLM is reloaded for every batch size, which becomes its `max_num_seqs`.')
+            load_groups = [[batch_size] for batch_size in backend_batch_sizes]
+        else:
+            load_groups = [backend_batch_sizes]
+        for group_batch_sizes in load_groups:
+            load_args = copy.deepcopy(backend_args)
+            if backend == 'vllm':
+                load_args.vllm_max_num_seqs = group_batch_sizes[0]
+            model, assistant_model, load_time = batching_inference.load_model(load_args)
+            print(f'{backend}: load_time = {load_time}')
+            if args.warmup:
+                warmup_args = copy.deepcopy(load_args)
+                warmup_args.max_new_tokens = min(max_new_tokens_list)
+                warmup_args.eval_batch_size = min(group_batch_sizes)
+                batching_inference.apply_speculative_args(warmup_args)
+                eval_data = datasets[0][1][:warmup_args.eval_batch_size]
+                batching_inference.generate(
+                    model, tokenizer, [example['prompt'] for example in eval_data], eval_data, warmup_args, assistant_model
+                )
+            for dataset_name, eval_data in datasets:
+                for max_new_tokens in max_new_tokens_list:
+                    for batch_size in group_batch_sizes:
+                        point_args = copy.deepcopy(load_args)
+                        point_args.max_new_tokens = max_new_tokens
+                        point_args.eval_batch_size = batch_size
+                        batching_inference.apply_speculative_args(point_args)
+                        row = run_point(model, assistant_model, tokenizer, eval_data, dataset_name, device_name, point_args)
+                        row['load_time'] = load_time
+                        rows.append(row)
+                        print(', '.join(f'{key} = {row[key]}' for key in COLUMNS))
+                        if args.results_db:
+                            results_db.save_run(
+                                args.results_db, 'batching_sweep',
+                                {
+                                    'backend': backend,
+                                    'model': args.model_name_or_path,
+                                    'dataset': dataset_name,
+                                    'device': device_name,
+                                    'args': vars(point_args),
+                                },
+                                [('warm', 0, row)],
+                            )
+            batching_inference.unload_model(model, load_args)
+            del model, assistant_model
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    f = io.StringIO()
+    writer = csv.DictWriter(f, fieldnames=COLUMNS + ['load_time'])
+    writer.writeheader()
+    writer.writerows(rows)
+    csv_str = f.getvalue()
+    os.makedirs('output/sweep', exist_ok=True)
+    output_file = f'output/sweep/{hashlib.md5(csv_str.encode("utf-8")).hexdigest()}.csv'
+    with open(output_file, 'w') as f:
+        f.write(csv_str)
+    print(f'The sweep ({len(rows)} points) is saved in {output_file}')
+
+
+if __name__ == '__main__':
+    # Every option of batching_inference.py applies to all the points, the
+    # lists below override the corresponding single-valued options.
+    parser = batching_inference.get_parser()
+    parser.add_argument(
+        "--backends",
+        type=str,
+        nargs="+",
+        default=None,
+        choices=["transformers", "vllm", "mii"],
+        help="Backends to sweep, each model is loaded once (once per batch size for vLLM). Defaults to `--backend`."
+    )
+    parser.add_argument(
+        "--batch_sizes",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Batch sizes to sweep. Defaults to `--eval_batch_size`."
+    )
+    parser.add_argument(
+        "--max_new_tokens_list",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Values of max_new_tokens to sweep. Defaults to `--max_new_tokens`."
+    )
+    parser.add_argument(
+        "--data_paths",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Datasets to sweep. Defaults to `--data_path`."
+    )
+    parser.add_argument(
+        "--warmup",
+        action="store_true",
+        help="If given, one batch is generated with every model before its first measured point."
+    )
+    args = parser.parse_args()
+
+    main(args)
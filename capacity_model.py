@@ -0,0 +1,195 @@
+import argparse
+
+import numpy as np
+
+import compare_runs
+
+
+# The server is modelled as a processor-sharing queue with batching:
+#   * the base service time of a request is drawn from the latencies measured
+#     at the lowest request rate, where requests hardly overlap;
+#   * with k requests in flight, each one progresses at 1 / (1 + alpha * (k - 1))
+#     of its base speed, alpha being fitted on the higher-rate runs;
+#   * at most `max_concurrency` requests are in flight, the others wait in FIFO order.
+
+
+def load_run(path, args):
+    run = compare_runs.load_run(path, args, keys=['start_time', 'end_time', 'latency', 'status'])
+    return {
+        'path': run['path'],
+        'request_rate': run['args']['request_rate'],
+        # Failed requests (instant errors, timeouts) are not service times.
+        'latency': np.concatenate([columns['latency'][columns['status'] == 'ok'] for columns in run['rounds']]),
+        'span': sum(columns['end_time'].max() - columns['start_time'].min() for columns in run['rounds']),
+    }
+
+
+def mean_concurrency(run):
+    # Little's law: time-averaged number of requests in flight.
+    return run['latency'].sum() / run['span']
+
+
+def fit_alpha(runs, base_service_time):
+    # Least squares fit of `latency / service time = 1 + alpha * (concurrency - 1)`.
+    x = np.array([mean_concurrency(run) - 1 for run in runs])
+    y = np.array([run['latency'].mean() / base_service_time.mean() - 1 for run in runs])
+    if len(runs) == 0 or np.sum(x * x) == 0:
+        return 0.0
+    return max(float(np.sum(x * y) / np.sum(x * x)), 0.0)
+
+
+def simulate(request_rate, service_time, alpha, max_concurrency, num_requests, seed):
+    rng = np.random.default_rng(seed)
+    arrivals = np.cumsum(rng.exponential(1.0 / request_rate, size=num_requests))
+    work = rng.choice(service_time, size=num_requests)
+    latency = np.zeros(num_requests)
+    remaining = {}
+    waiting = []
+    now = 0.0
+    next_arrival = 0
+    while next_arrival < num_requests or remaining or waiting:
+        while waiting and len(remaining) < max_concurrency:
+            idx = waiting.pop(0)
+            remaining[idx] = work[idx]
+        speed = 1.0 / (1.0 + alpha * (len(remaining) - 1)) if remaining else 0.0
+        if remaining:
+            finish_idx = min(remaining, key=remaining.get)
+            finish_time = now + remaining[finish_idx] / speed
+        else:
+            finish_time = float('inf')
+        arrival_time = arrivals[next_arrival] if next_arrival < num_requests else float('inf')
+        step = min(finish_time, arrival_time) - now
+        for idx in remaining:
+            remaining[idx] -= step * speed
+        now += step
+        if finish_time <= arrival_time:
+            del remaining[finish_idx]
+            latency[finish_idx] = now - arrivals[finish_idx]
+        else:
+            waiting.append(next_arrival)
+            next_arrival += 1
+    return latency
+
+
+def predict(request_rate, model, args):
+    return simulate(
+        request_rate, model['service_time'], model['alpha'],
+        args.max_concurrency, args.num_simulated_requests, args.seed,
+    )
+
+
+def fit(runs):
+    runs = sorted(runs, key=lambda run: run['request_rate'])
+    base_service_time = runs[0]['latency']
+    return {
+        'service_time': base_service_time,
+        'alpha': fit_alpha(runs[1:], base_service_time),
+        'base_rate': runs[0]['request_rate'],
+    }
+
+
+def main(args):
+    runs = [load_run(path, args) for path in args.runs]
+    runs = [run for run in runs if run['request_rate'] != float('inf')]
+    if len(runs) < 2:
+        raise ValueError('At least two runs with a finite request rate are required.')
+    runs = sorted(runs, key=lambda run: run['request_rate'])
+    percentiles = [50, 90, 99]
+
+    model = fit(runs)
+    print(f'Service time (from {model["base_rate"]} requests/s): '
+        f'mean = {model["service_time"].mean():.3f} s, P90 = {np.percentile(model["service_time"], 90):.3f} s')
+    print(f'Batching slowdown per extra request in flight: alpha = {model["alpha"]:.4f}')
+    print()
+
+    # Leave one higher-rate run out, refit and predict it.
+    print('Held-out prediction error:')
+    errors = []
+    for held_out in range(1, len(runs)):
+        held_out_model = fit(runs[:held_out] + runs[held_out + 1:])
+        latency = predict(runs[held_out]['request_rate'], held_out_model, args)
+        row = []
+        for p in percentiles:
+            predicted = np.percentile(latency, p)
+            measured = np.percentile(runs[held_out]['latency'], p)
+            error = (predicted - measured) / measured
+            errors.append(abs(error))
+            row.append(f'P{p} {predicted:.2f}/{measured:.2f} s ({error * 100:+.1f}%)')
+        print(f'  {runs[held_out]["request_rate"]:.2f} requests/s: predicted/measured ' + ', '.join(row))
+    if errors:
+        print(f'  Mean absolute relative error: {np.mean(errors) * 100:.1f}%')
+    print()
+
+    if args.target_rate is not None:
+        latency = predict(args.target_rate, model, args)
+        print(f'Predicted latency at {args.target_rate:.2f} requests/s on one replica: '
+            + ', '.join(f'P{p} = {np.percentile(latency, p):.2f} s' for p in percentiles))
+        if args.slo_latency is not None:
+            for replicas in range(1, args.max_replicas + 1):
+                latency = predict(args.target_rate / replicas, model, args)
+                if np.percentile(latency, args.slo_percentile) <= args.slo_latency:
+                    print(f'Replicas needed for P{args.slo_percentile:g} <= {args.slo_latency:.2f} s: {replicas}')
+                    break
+            else:
+                print(f'The SLO cannot be met with up to {args.max_replicas} replicas.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "runs",
+        type=str,
+        nargs='+',
+        help="Output files of serving_inference.py measured at different request rates.",
+    )
+    parser.add_argument(
+        "--trim",
+        type=int,
+        default=100,
+        help="Number of requests ignored at the start and the end of every round."
+    )
+    parser.add_argument(
+        "--target_rate",
+        type=float,
+        default=None,
+        help="Request rate (requests per second) to predict the latency for."
+    )
+    parser.add_argument(
+        "--slo_latency",
+        type=float,
+        default=None,
+        help="Latency objective in seconds, used to compute the number of replicas."
+    )
+    parser.add_argument(
+        "--slo_percentile",
+        type=float,
+        default=90,
+        help="Percentile of the latency that must stay below `slo_latency`."
+    )
+    parser.add_argument(
+        "--max_replicas",
+        type=int,
+        default=64,
+        help="Largest number of replicas considered."
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=256,
+        help="Maximum number of requests a replica runs at the same time (e.g. max_num_seqs of vLLM)."
+    )
+    parser.add_argument(
+        "--num_simulated_requests",
+        type=int,
+        default=2000,
+        help="Number of requests of each simulation."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=42,
+        help="Random seed."
+    )
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,116 @@
+import os
+import json
+import zlib
+
+import numpy as np
+
+
+# Per-request records stored column by column: one `.npy` file per field in
+# a directory, so analysis can memory-map only the columns it needs. Rows keep
+# the order of the (phase, round) groups they are written in. Texts go to an
+# optional `texts.jsonl` file with one line per row.
+FLOAT_COLUMNS = [
+    'scheduled_time', 'start_time', 'first_token_time', 'end_time', 'latency', 'ttft', 'parse_time', 'priority',
+]
+INT_COLUMNS = ['prompt_tokens', 'output_tokens', 'num_sequences', 'retries', 'session', 'turn']
+# Categorical fields are stored as int16 codes into the lists of `meta.json`.
+CATEGORY_COLUMNS = ['phase', 'status', 'tenant']
+TEXT_KEYS = ['prompt', 'output', 'sequences', 'error']
+META_FILE = 'meta.json'
+TEXTS_FILE = 'texts.jsonl'
+
+
+def prompt_hash(prompt):
+    return zlib.crc32(prompt.encode('utf-8'))
+
+
+def records_to_columns(records):
+    # Missing values are NaN for float columns and -1 for integer columns.
+    columns = {
+        key: np.array([np.nan if record.get(key) is None else record[key] for record in records], dtype=np.float64)
+        for key in FLOAT_COLUMNS
+    }
+    for key in INT_COLUMNS:
+        columns[key] = np.array([-1 if record.get(key) is None else record[key] for record in records], dtype=np.int32)
+    columns['prompt_hash'] = np.array(
+        [record['prompt_hash'] if 'prompt_hash' in record else prompt_hash(record.get('prompt', '')) for record in records],
+        dtype=np.uint32,
+    )
+    columns['status'] = np.array([record.get('status', 'ok') for record in records])
+    columns['tenant'] = np.array([str(record.get('tenant')) for record in records])
+    return columns
+
+
+def write_columns(directory, requests, save_texts=False):
+    # `requests` is a list of (phase, round, records), as for results_db.save_run.
+    os.makedirs(directory, exist_ok=True)
+    phases, rounds, records = [], [], []
+    for phase, round, outputs in requests:
+        phases.extend([phase] * len(outputs))
+        rounds.extend([round] * len(outputs))
+        records.extend(outputs)
+    columns = records_to_columns(records)
+    columns['phase'] = np.array(phases)
+    columns['round'] = np.array(rounds, dtype=np.int32)
+    columns['idx'] = np.array([idx for _, _, outputs in requests for idx in range(len(outputs))], dtype=np.int32)
+
+    meta = {'num_rows': len(records), 'categories': {}}
+    for key in CATEGORY_COLUMNS:
+        categories, codes = np.unique(columns[key], return_inverse=True)
+        meta['categories'][key] = categories.tolist()
+        columns[key] = codes.astype(np.int16)
+    for key, values in columns.items():
+        np.save(os.path.join(directory, f'{key}.npy'), values)
+    meta['columns'] = sorted(columns)
+    with open(os.path.join(directory, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    texts_file = os.path.join(directory, TEXTS_FILE)
+    if save_texts:
+        with open(texts_file, 'w') as f:
+            for record in records:
+                f.write(json.dumps({key: record.get(key) for key in TEXT_KEYS}) + '\n')
+    elif os.path.exists(texts_file):
+        os.remove(texts_file)
+
+
+def load_meta(directory):
+    with open(os.path.join(directory, META_FILE), 'r') as f:
+        return json.load(f)
+
+
+def load_columns(directory, keys=None):
+    # Columns are memory-mapped, only the pages that are read are loaded.
+    meta = load_meta(directory)
+    return {
+        key: np.load(os.path.join(directory, f'{key}.npy'), mmap_mode='r')
+        for key in (keys or meta['columns'])
+    }
+
+
+def category_code(meta, key, value):
+    categories = meta['categories'][key]
+    return categories.index(value) if value in categories else -1
+
+
+def load_phase(directory, phase, keys):
+    # The rows of one phase split by round, with categorical codes decoded,
+    # in the same layout as `records_to_columns`.
+    meta = load_meta(directory)
+    columns = load_columns(directory, set(keys) | {'phase', 'round'})
+    mask = columns['phase'] == category_code(meta, 'phase', phase)
+    rounds = []
+    for round in np.unique(columns['round'][mask]):
+        round_mask = mask & (columns['round'] == round)
+        rounds.append({
+            key: np.array(meta['categories'][key])[columns[key][round_mask]]
+            if key in CATEGORY_COLUMNS else np.asarray(columns[key][round_mask])
+            for key in keys
+        })
+    return rounds
+
+
+def iter_texts(directory):
+    with open(os.path.join(directory, TEXTS_FILE), 'r') as f:
+        for line in f:
+            yield json.loads(line)
@@ -0,0 +1,360 @@
+import os
+import argparse
+import json
+import sys
+
+import numpy as np
+
+import columnar
+
+
+# Record fields holding generated or prompt text. They are dropped while the
+# log is parsed, so only the timings of a run are held in memory.
+TEXT_KEYS = ('prompt', 'output', 'sequences')
+CHUNK_SIZE = 1 << 20
+LOOKAHEAD = 64
+WHITESPACE = ' \t\n\r'
+COLUMNS = ['start_time', 'end_time', 'latency', 'ttft', 'status', 'prompt_hash']
+
+
+class JsonStream:
+    # Incremental reader of a JSON document: the structure is walked value by
+    # value and only a small window of the file is kept in the buffer.
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        chunk = self.f.read(CHUNK_SIZE)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                raise ValueError('Unexpected end of the JSON document.')
+            self.fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'Expected `{char}` at position {self.pos} of the buffer.')
+        self.pos += 1
+
+    def scalar(self):
+        self.peek()
+        while True:
+            # A number at the end of the buffer may continue in the next chunk,
+            # so a few characters of lookahead are kept.
+            if len(self.buffer) - self.pos < LOOKAHEAD and not self.eof:
+                self.fill()
+                continue
+            try:
+                value, self.pos = self.decoder.raw_decode(self.buffer, self.pos)
+                return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def items(self):
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.scalar()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect('}')
+                return
+
+    def elements(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+    def value(self):
+        char = self.peek()
+        if char == '{':
+            value = {}
+            for key in self.items():
+                item = self.value()
+                if key == 'prompt' and isinstance(item, str):
+                    # Requests are aligned across runs by their prompts.
+                    value['prompt_hash'] = columnar.prompt_hash(item)
+                elif key not in TEXT_KEYS:
+                    value[key] = item
+            return value
+        elif char == '[':
+            return [self.value() for _ in self.elements()]
+        return self.scalar()
+
+
+def resolve_path(run):
+    if os.path.exists(run):
+        return run
+    return f'output/benchmark/{run}.json'
+
+
+def load_run(run, args, keys=COLUMNS):
+    # Every round of the warm phase as a dict of per-request columns, read
+    # from the columnar directory of the run when there is one.
+    path = resolve_path(run)
+    with open(path, 'r', encoding='utf-8') as f:
+        log = JsonStream(f).value()
+    if 'columns' in log:
+        rounds = columnar.load_phase(os.path.join(os.path.dirname(path), log['columns']), 'warm', keys)
+    else:
+        rounds = [columnar.records_to_columns(outputs) for outputs in log['outputs']]
+    trim = args.trim if args.trim is not None else log['args'].get('trim', 0)
+    rounds = [
+        {key: columns[key][trim:len(columns[key]) - trim] for key in keys}
+        for columns in rounds
+    ]
+    rounds = [columns for columns in rounds if len(columns['status'])]
+    if not rounds:
+        raise ValueError(f'{path} has no measured requests left after trimming {trim} requests.')
+    return {
+        'path': path,
+        'args': log['args'],
+        'rounds': rounds,
+        'warm_metrics': log.get('phases', {}).get('warm', {}).get('metrics', {}),
+    }
+
+
+def round_throughput(columns):
+    ok = np.sum(columns['status'] == 'ok')
+    return ok / (columns['end_time'].max() - columns['start_time'].min())
+
+
+def request_matrix(run, key):
+    # (rounds, requests) matrix of a per-request metric, NaN for failed
+    # requests and missing values.
+    num_requests = min(len(columns['status']) for columns in run['rounds'])
+    return np.array([
+        np.where(columns['status'][:num_requests] == 'ok', columns[key][:num_requests], np.nan)
+        for columns in run['rounds']
+    ])
+
+
+def align(baseline, candidate):
+    # Requests are paired by position when both runs sent the same prompts in
+    # the same order, otherwise by prompt.
+    base_hashes = baseline['rounds'][0]['prompt_hash']
+    cand_hashes = candidate['rounds'][0]['prompt_hash']
+    num_requests = min(len(base_hashes), len(cand_hashes))
+    if np.array_equal(base_hashes[:num_requests], cand_hashes[:num_requests]):
+        return np.arange(num_requests), np.arange(num_requests)
+    cand_position = {}
+    for idx, prompt_hash in enumerate(cand_hashes.tolist()):
+        cand_position.setdefault(prompt_hash, idx)
+    pairs = [
+        (idx, cand_position[prompt_hash])
+        for idx, prompt_hash in enumerate(base_hashes.tolist())
+        if prompt_hash in cand_position
+    ]
+    if not pairs:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    base_idx, cand_idx = zip(*pairs)
+    return np.array(base_idx), np.array(cand_idx)
+
+
+def bootstrap_ci(statistic, rng, args):
+    alpha = (1 - args.confidence) / 2
+    return np.nanpercentile(
+        [statistic(rng) for _ in range(args.num_bootstrap)], [alpha * 100, (1 - alpha) * 100]
+    )
+
+
+def compare_percentile(base, cand, q, rng, args):
+    # Paired bootstrap: the same requests (with all their rounds) are
+    # resampled in both runs.
+    num_requests = base.shape[1]
+
+    def relative_change(indices):
+        base_value = np.nanpercentile(base[:, indices], q)
+        return (np.nanpercentile(cand[:, indices], q) - base_value) / base_value
+
+    change = relative_change(np.arange(num_requests))
+    low, high = bootstrap_ci(
+        lambda rng: relative_change(rng.integers(0, num_requests, num_requests)), rng, args
+    )
+    return np.nanpercentile(base, q), np.nanpercentile(cand, q), change, low, high
+
+
+def compare_throughput(base, cand, rng, args):
+    # Unpaired bootstrap of the mean over rounds, with a Welch t statistic as
+    # a cross-check when both runs have several rounds.
+    base, cand = np.asarray(base), np.asarray(cand)
+    change = (cand.mean() - base.mean()) / base.mean()
+    if len(base) < 2 or len(cand) < 2:
+        return base.mean(), cand.mean(), change, np.nan, np.nan, np.nan
+
+    def resampled_change(rng):
+        base_mean = rng.choice(base, len(base)).mean()
+        return (rng.choice(cand, len(cand)).mean() - base_mean) / base_mean
+
+    low, high = bootstrap_ci(resampled_change, rng, args)
+    stderr = np.sqrt(base.var(ddof=1) / len(base) + cand.var(ddof=1) / len(cand))
+    welch_t = (cand.mean() - base.mean()) / stderr if stderr > 0 else np.nan
+    return base.mean(), cand.mean(), change, low, high, welch_t
+
+
+def verdict(change, low, threshold):
+    # `change` is oriented so that positive is worse. A metric regresses when
+    # the change exceeds the threshold and the confidence interval excludes 0.
+    significant = np.isnan(low) or low > 0
+    if change > threshold and significant:
+        return 'FAIL'
+    elif change > threshold:
+        return 'noise'
+    return 'ok'
+
+
+def compare(baseline, candidate, args):
+    rng = np.random.default_rng(args.seed)
+    rows = []
+
+    base_throughput = baseline['warm_metrics'].get('sequence_throughput') or list(map(round_throughput, baseline['rounds']))
+    cand_throughput = candidate['warm_metrics'].get('sequence_throughput') or list(map(round_throughput, candidate['rounds']))
+    base_value, cand_value, change, low, high, welch_t = compare_throughput(base_throughput, cand_throughput, rng, args)
+    rows.append({
+        'metric': 'throughput (requests/s)', 'baseline': base_value, 'candidate': cand_value,
+        'change': change, 'low': low, 'high': high, 'welch_t': welch_t,
+        'verdict': verdict(-change, -high, args.max_throughput_drop / 100),
+    })
+
+    base_idx, cand_idx = align(baseline, candidate)
+    print(f'Aligned requests: {len(base_idx)} (baseline {len(baseline["rounds"][0]["status"])}, '
+        f'candidate {len(candidate["rounds"][0]["status"])})')
+    if len(base_idx) == 0:
+        return rows
+    percentiles = [float(p) for p in args.percentiles.split(',')]
+    for key, name, scale, threshold in [
+        ('latency', 'latency', 1, args.max_latency_increase),
+        ('ttft', 'TTFT', 1000, args.max_ttft_increase),
+    ]:
+        base = request_matrix(baseline, key)[:, base_idx]
+        cand = request_matrix(candidate, key)[:, cand_idx]
+        if np.all(np.isnan(base)) or np.all(np.isnan(cand)):
+            continue
+        for q in percentiles:
+            base_value, cand_value, change, low, high = compare_percentile(base, cand, q, rng, args)
+            rows.append({
+                'metric': f'P{q:g} {name} ({"ms" if scale == 1000 else "s"})',
+                'baseline': base_value * scale, 'candidate': cand_value * scale,
+                'change': change, 'low': low, 'high': high, 'welch_t': np.nan,
+                'verdict': verdict(change, low, threshold / 100),
+            })
+    return rows
+
+
+def print_report(rows, args):
+    print(f'{"metric":<26} {"baseline":>10} {"candidate":>10} {"change":>8} '
+        f'{int(args.confidence * 100)}% CI{"":<12} {"welch t":>8}  verdict')
+    for row in rows:
+        ci = '' if np.isnan(row['low']) else f'[{row["low"] * 100:+.1f}%, {row["high"] * 100:+.1f}%]'
+        welch_t = '' if np.isnan(row['welch_t']) else f'{row["welch_t"]:.2f}'
+        print(f'{row["metric"]:<26} {row["baseline"]:>10.3f} {row["candidate"]:>10.3f} '
+            f'{row["change"] * 100:>+7.1f}% {ci:<18} {welch_t:>8}  {row["verdict"]}')
+
+
+def main(args):
+    baseline = load_run(args.runs[0], args)
+    print(f'Baseline: {baseline["path"]} ({len(baseline["rounds"])} rounds)')
+    failed = False
+    for run in args.runs[1:]:
+        candidate = load_run(run, args)
+        print()
+        print(f'Candidate: {candidate["path"]} ({len(candidate["rounds"])} rounds)')
+        for key in ['backend', 'data_path', 'request_rate', 'max_tokens_policy']:
+            if baseline['args'].get(key) != candidate['args'].get(key):
+                print(f'Warning: `{key}` differs: {baseline["args"].get(key)} vs {candidate["args"].get(key)}')
+        rows = compare(baseline, candidate, args)
+        print_report(rows, args)
+        result = 'FAIL' if any(row['verdict'] == 'FAIL' for row in rows) else 'PASS'
+        failed = failed or result == 'FAIL'
+        print(f'Result: {result}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "runs",
+        type=str,
+        nargs='+',
+        help="Output files (or their md5 names in output/benchmark) of serving_inference.py. "
+            "The first one is the baseline, the others are compared with it.",
+    )
+    parser.add_argument(
+        "--trim",
+        type=int,
+        default=None,
+        help="Number of requests ignored at the start and the end of every round. Defaults to the `trim` of each run."
+    )
+    parser.add_argument(
+        "--percentiles",
+        type=str,
+        default="50,90,99",
+        help="Comma separated latency and TTFT percentiles to compare."
+    )
+    parser.add_argument(
+        "--max_throughput_drop",
+        type=float,
+        default=5.0,
+        help="Largest tolerated drop of the sequence throughput (%%)."
+    )
+    parser.add_argument(
+        "--max_latency_increase",
+        type=float,
+        default=10.0,
+        help="Largest tolerated increase of every latency percentile (%%)."
+    )
+    parser.add_argument(
+        "--max_ttft_increase",
+        type=float,
+        default=10.0,
+        help="Largest tolerated increase of every TTFT percentile (%%)."
+    )
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="Confidence level of the bootstrap intervals."
+    )
+    parser.add_argument(
+        "--num_bootstrap",
+        type=int,
+        default=1000,
+        help="Number of bootstrap resamples."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=42,
+        help="Random seed of the bootstrap."
+    )
+    args = parser.parse_args()
+
+    sys.exit(main(args))
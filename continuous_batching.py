@@ -0,0 +1,305 @@
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+import transformers
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+
+# Iteration-level scheduling on top of the forward pass of a Hugging Face
+# causal LM, in the spirit of the continuous batching of vLLM and TGI:
+#   * after every decode step finished sequences leave the batch, so they stop
+#     costing compute, and waiting prompts are admitted into the free slots;
+#   * admitted prompts are prefilled together, then their KV cache is merged
+#     into the running one;
+#   * the KV cache of the batch is one left-padded tensor per layer, the
+#     attention mask hides the padding and the columns that only hold padding
+#     are dropped after every eviction.
+# Decoding is greedy, like the other backends of batching_inference.py.
+
+
+def cache_to_tuples(past_key_values):
+    # (key, value) tensors of shape (batch, kv heads, length, head dim) per layer.
+    if isinstance(past_key_values, (tuple, list)):
+        return tuple(past_key_values)
+    elif hasattr(past_key_values, 'layers'):
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    return tuple(zip(past_key_values.key_cache, past_key_values.value_cache))
+
+
+def tuples_to_cache(past_key_values):
+    if DynamicCache is None:
+        return past_key_values
+    elif hasattr(DynamicCache, 'from_legacy_cache'):
+        return DynamicCache.from_legacy_cache(past_key_values)
+    return DynamicCache(past_key_values)
+
+
+def pad_left(past_key_values, attention_mask, length):
+    pad = length - attention_mask.size(1)
+    if pad == 0:
+        return past_key_values, attention_mask
+    past_key_values = tuple(
+        (F.pad(key, (0, 0, pad, 0)), F.pad(value, (0, 0, pad, 0)))
+        for key, value in past_key_values
+    )
+    return past_key_values, F.pad(attention_mask, (pad, 0))
+
+
+class ContinuousBatchingEngine:
+
+    def __init__(self, model, pad_token_id, eos_token_id=None, max_batch_size=8, max_batch_tokens=None,
+                 stop_token_ids=None):
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.pad_token_id = pad_token_id
+        # `eos_token_id` is None to ignore EOS.
+        self.eos_token_id = eos_token_id
+        self.max_batch_size = max_batch_size
+        # KV cache tokens reserved by the running sequences (prompt + max_new_tokens each).
+        self.max_batch_tokens = max_batch_tokens
+        # A sequence also finishes when its output ends with one of these token patterns.
+        self.stop_token_ids = stop_token_ids or []
+
+    def forward(self, input_ids, attention_mask, position_ids, past_key_values):
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=None if past_key_values is None else tuples_to_cache(past_key_values),
+            use_cache=True,
+        )
+        return out.logits[:, -1, :].argmax(dim=-1), cache_to_tuples(out.past_key_values)
+
+    def can_admit(self, sequence, admitted):
+        if len(self.running) + len(admitted) >= self.max_batch_size:
+            return False
+        if self.max_batch_tokens is None or not self.running + admitted:
+            return True
+        reserved = sum(len(seq['prompt_ids']) + seq['max_new_tokens'] for seq in self.running + admitted)
+        return reserved + len(sequence['prompt_ids']) + sequence['max_new_tokens'] <= self.max_batch_tokens
+
+    def admit(self):
+        admitted = []
+        while self.waiting and self.can_admit(self.waiting[0], admitted):
+            admitted.append(self.waiting.pop(0))
+        if not admitted:
+            return
+        length = max(len(seq['prompt_ids']) for seq in admitted)
+        input_ids = torch.full((len(admitted), length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(admitted), length), dtype=torch.long)
+        for row, seq in enumerate(admitted):
+            input_ids[row, length - len(seq['prompt_ids']):] = torch.tensor(seq['prompt_ids'])
+            attention_mask[row, length - len(seq['prompt_ids']):] = 1
+        input_ids, attention_mask = input_ids.to(self.device), attention_mask.to(self.device)
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        next_tokens, past_key_values = self.forward(input_ids, attention_mask, position_ids, None)
+        self.stats['prefill_steps'] += 1
+        self.append_tokens(admitted, next_tokens)
+
+        if self.running:
+            length = max(length, self.attention_mask.size(1))
+            self.past_key_values, self.attention_mask = pad_left(self.past_key_values, self.attention_mask, length)
+            past_key_values, attention_mask = pad_left(past_key_values, attention_mask, length)
+            past_key_values = tuple(
+                (torch.cat([key, new_key]), torch.cat([value, new_value]))
+                for (key, value), (new_key, new_value) in zip(self.past_key_values, past_key_values)
+            )
+            attention_mask = torch.cat([self.attention_mask, attention_mask])
+            next_tokens = torch.cat([self.next_tokens, next_tokens])
+        self.running.extend(admitted)
+        self.past_key_values, self.attention_mask, self.next_tokens = past_key_values, attention_mask, next_tokens
+
+    def decode(self):
+        attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+        position_ids = attention_mask.sum(dim=-1, keepdim=True) - 1
+        self.next_tokens, self.past_key_values = self.forward(
+            self.next_tokens[:, None], attention_mask, position_ids, self.past_key_values
+        )
+        self.attention_mask = attention_mask
+        self.stats['decode_steps'] += 1
+        self.stats['decode_batch_size'] += len(self.running)
+        self.append_tokens(self.running, self.next_tokens)
+
+    def append_tokens(self, sequences, next_tokens):
+        now = time.time()
+        for seq, token in zip(sequences, next_tokens.tolist()):
+            if not seq['output_ids']:
+                seq['first_token_time'] = now
+            seq['output_ids'].append(token)
+
+    def is_finished(self, seq):
+        output_ids = seq['output_ids']
+        if len(output_ids) >= seq['max_new_tokens']:
+            return True
+        if self.eos_token_id is not None and output_ids[-1] == self.eos_token_id:
+            return True
+        seq['stopped'] = any(
+            output_ids[-len(stop):] == stop for stop in self.stop_token_ids if len(output_ids) >= len(stop)
+        )
+        return seq['stopped']
+
+    def evict(self):
+        keep = [row for row, seq in enumerate(self.running) if not self.is_finished(seq)]
+        if len(keep) == len(self.running):
+            return
+        now = time.time()
+        for row, seq in enumerate(self.running):
+            if row not in keep:
+                seq['end_time'] = now
+        self.running = [self.running[row] for row in keep]
+        if not self.running:
+            self.past_key_values = self.attention_mask = self.next_tokens = None
+            return
+        index = torch.tensor(keep, device=self.device)
+        self.attention_mask = self.attention_mask[index]
+        self.next_tokens = self.next_tokens[index]
+        # Drop the leading columns that are padding for every remaining sequence.
+        start = int(self.attention_mask.any(dim=0).int().argmax())
+        self.attention_mask = self.attention_mask[:, start:]
+        self.past_key_values = tuple(
+            (key[index, :, start:], value[index, :, start:])
+            for key, value in self.past_key_values
+        )
+
+    @torch.no_grad()
+    def generate(self, prompts_ids, max_new_tokens):
+        # Requests are admitted in the given order. `max_new_tokens` is an int
+        # or one value per prompt. Returns the generated token ids in the order
+        # of the prompts and the scheduling statistics.
+        if isinstance(max_new_tokens, int):
+            max_new_tokens = [max_new_tokens] * len(prompts_ids)
+        sequences = [
+            {'prompt_ids': list(prompt_ids), 'max_new_tokens': num, 'output_ids': []}
+            for prompt_ids, num in zip(prompts_ids, max_new_tokens)
+        ]
+        self.waiting = list(sequences)
+        self.running = []
+        self.past_key_values = self.attention_mask = self.next_tokens = None
+        self.stats = {
+            'prefill_steps': 0, 'decode_steps': 0, 'decode_batch_size': 0,
+            'prefill_time': 0, 'decode_time': 0, 'schedule_time': 0,
+        }
+        start_time = time.time()
+        # Reading the new tokens back synchronizes the device after every
+        # forward, so the phase times need no explicit synchronization.
+        while self.waiting or self.running:
+            step_start_time = time.time()
+            self.admit()
+            prefill_end_time = time.time()
+            self.evict()
+            self.stats['prefill_time'] += prefill_end_time - step_start_time
+            self.stats['schedule_time'] += time.time() - prefill_end_time
+            if self.running:
+                decode_start_time = time.time()
+                self.decode()
+                decode_end_time = time.time()
+                self.evict()
+                self.stats['decode_time'] += decode_end_time - decode_start_time
+                self.stats['schedule_time'] += time.time() - decode_end_time
+        self.stats['avg_decode_batch_size'] = self.stats.pop('decode_batch_size') / max(self.stats['decode_steps'], 1)
+        self.stats['avg_ttft'] = sum(seq['first_token_time'] - start_time for seq in sequences) / len(sequences)
+        self.stats['avg_latency'] = sum(seq['end_time'] - start_time for seq in sequences) / len(sequences)
+        stopped = [seq for seq in sequences if seq.get('stopped')]
+        self.stats['stopped_sequences'] = len(stopped)
+        self.stats['tokens_saved'] = sum(seq['max_new_tokens'] - len(seq['output_ids']) for seq in stopped)
+        return [seq['output_ids'] for seq in sequences], self.stats
+
+
+def tiny_llama(args):
+    config = transformers.LlamaConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=512,
+    )
+    return transformers.LlamaForCausalLM(config).eval().to(args.device)
+
+
+@torch.no_grad()
+def main(args):
+    # Smoke test on a randomly initialized tiny Llama: the continuous batching
+    # outputs must match greedy `generate` run one prompt at a time.
+    torch.manual_seed(args.seed)
+    model = tiny_llama(args)
+    generator = torch.Generator().manual_seed(args.seed)
+    prompts_ids = [
+        torch.randint(1, args.vocab_size, (int(length),), generator=generator).tolist()
+        for length in torch.randint(1, args.max_prompt_length + 1, (args.num_requests,), generator=generator)
+    ]
+    max_new_tokens = torch.randint(1, args.max_new_tokens + 1, (args.num_requests,), generator=generator).tolist()
+
+    engine = ContinuousBatchingEngine(
+        model, pad_token_id=0, eos_token_id=model.config.eos_token_id, max_batch_size=args.max_batch_size
+    )
+    start_time = time.time()
+    outputs, stats = engine.generate(prompts_ids, max_new_tokens)
+    print(f'continuous batching: {time.time() - start_time:.2f} s, {stats}')
+
+    mismatch = 0
+    for prompt_ids, num, output_ids in zip(prompts_ids, max_new_tokens, outputs):
+        input_ids = torch.tensor([prompt_ids], device=args.device)
+        expected = model.generate(
+            input_ids, attention_mask=torch.ones_like(input_ids), max_new_tokens=num, do_sample=False, pad_token_id=0,
+        )[0, len(prompt_ids):].tolist()
+        mismatch += output_ids != expected
+    print(f'Sequences differing from sequential greedy decoding: {mismatch} / {len(prompts_ids)}')
+    if mismatch:
+        raise AssertionError('Continuous batching does not reproduce greedy decoding.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cpu",
+        help="Device of the smoke test."
+    )
+    parser.add_argument(
+        "--num_requests",
+        type=int,
+        default=32,
+        help="Number of random prompts."
+    )
+    parser.add_argument(
+        "--max_prompt_length",
+        type=int,
+        default=24,
+        help="Maximum length of the random prompts."
+    )
+    parser.add_argument(
+        "--max_new_tokens",
+        type=int,
+        default=16,
+        help="Maximum number of new tokens of every request."
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=4,
+        help="Maximum number of sequences in the running batch."
+    )
+    parser.add_argument(
+        "--vocab_size",
+        type=int,
+        default=128,
+        help="Vocabulary size of the tiny model."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=42,
+        help="Random seed."
+    )
+    args = parser.parse_args()
+
+    main(args)
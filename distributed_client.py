@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import time
+
+import serving_inference
+
+
+# Messages are newline delimited JSON objects. The schedule of a whole round
+# can be large, so the stream buffer limit is raised accordingly.
+STREAM_LIMIT = 2**30
+TIME_KEYS = ('scheduled_time', 'start_time', 'first_token_time', 'end_time')
+
+
+async def send_message(writer, message):
+    writer.write(serving_inference.json_dumps(message) + b'\n')
+    await writer.drain()
+
+
+async def recv_message(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError('The connection is closed by the peer.')
+    return serving_inference.json_loads(line)
+
+
+def parse_workers(workers):
+    addresses = []
+    for worker in workers.split(','):
+        host, port = worker.strip().rsplit(':', 1)
+        addresses.append((host, int(port)))
+    return addresses
+
+
+async def estimate_clock_offset(reader, writer, sync_rounds):
+    # NTP style estimation: the sample with the smallest round trip time gives
+    # the tightest bound on `worker_clock - coordinator_clock`.
+    best_rtt, best_offset = float('inf'), 0.0
+    for _ in range(sync_rounds):
+        send_time = time.time()
+        await send_message(writer, {'type': 'ping'})
+        message = await recv_message(reader)
+        recv_time = time.time()
+        rtt = recv_time - send_time
+        if rtt < best_rtt:
+            best_rtt = rtt
+            best_offset = message['time'] - (send_time + recv_time) / 2
+    return best_offset, best_rtt
+
+
+async def run_worker_round(address, requests, schedule, indices, start_time, args):
+    reader, writer = await asyncio.open_connection(*address, limit=STREAM_LIMIT)
+    try:
+        offset, rtt = await estimate_clock_offset(reader, writer, args.clock_sync_rounds)
+        print(f'Worker {address[0]}:{address[1]}: clock offset = {offset * 1000:.3f} ms, '
+            f'rtt = {rtt * 1000:.3f} ms, requests = {len(indices)}')
+        await send_message(writer, {
+            'type': 'run',
+            'args': {
+                'backend': args.backend,
+                'api_url': args.api_url,
+                'client_num': args.client_num,
+                'json_lib': args.json_lib,
+                'request_timeout': args.request_timeout,
+                'max_retries': args.max_retries,
+            },
+            'requests': [
+                dict(requests[idx], payload=requests[idx]['payload'].decode('utf-8'))
+                for idx in indices
+            ],
+            'schedule': [schedule[idx] - schedule[indices[0]] for idx in indices],
+            'start_time': start_time + schedule[indices[0]] + offset,
+        })
+        message = await recv_message(reader)
+        await send_message(writer, {'type': 'close'})
+    finally:
+        writer.close()
+        await writer.wait_closed()
+    # Move the timestamps of the worker back to the clock of the coordinator.
+    outputs = message['outputs']
+    for output in outputs:
+        for key in TIME_KEYS:
+            if output.get(key) is not None:
+                output[key] -= offset
+    return outputs
+
+
+async def coordinate(requests, args):
+    addresses = parse_workers(args.workers)
+    schedule = serving_inference.build_schedule(len(requests), args.request_rate)
+    # Round-robin keeps the global arrival process intact: every worker sends
+    # an evenly thinned slice of the same schedule.
+    worker_indices = [
+        list(range(worker_id, len(requests), len(addresses)))
+        for worker_id in range(len(addresses))
+    ]
+    start_time = time.time() + args.start_delay
+    worker_outputs = await asyncio.gather(*[
+        run_worker_round(address, requests, schedule, indices, start_time, args)
+        for address, indices in zip(addresses, worker_indices)
+        if indices
+    ])
+    outputs = [None] * len(requests)
+    for indices, records in zip(worker_indices, worker_outputs):
+        for idx, record in zip(indices, records):
+            outputs[idx] = record
+    return outputs
+
+
+async def handle_coordinator(reader, writer):
+    try:
+        while True:
+            message = await recv_message(reader)
+            if message['type'] == 'ping':
+                await send_message(writer, {'type': 'pong', 'time': time.time()})
+            elif message['type'] == 'run':
+                args = serving_inference.get_parser().parse_args([])
+                vars(args).update(message['args'])
+                serving_inference.use_json_lib(args.json_lib)
+                requests = [
+                    dict(request, payload=request['payload'].encode('utf-8'))
+                    for request in message['requests']
+                ]
+                outputs = await serving_inference.benchmark(
+                    requests, args, schedule=message['schedule'], start_time=message['start_time']
+                )
+                await send_message(writer, {'type': 'result', 'outputs': outputs})
+            elif message['type'] == 'close':
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def serve(args):
+    server = await asyncio.start_server(handle_coordinator, args.host, args.port, limit=STREAM_LIMIT)
+    print(f'Worker is listening on {args.host}:{args.port}')
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Address the worker listens on."
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=9100,
+        help="Port the worker listens on."
+    )
+    args = parser.parse_args()
+
+    asyncio.run(serve(args))
@@ -0,0 +1,255 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+# A zero-latency stand-in for the vLLM, DeepSpeed-MII and llama.cpp servers.
+# Every request is answered immediately with `max_tokens` copies of TOKEN, so
+# only the client and the HTTP stack are exercised, unless faults are injected.
+TOKEN = ' a'
+FAULT_KINDS = ['5xx', 'reset', 'drip', 'stall', 'gc']
+
+
+def completion(max_tokens):
+    return TOKEN * max_tokens
+
+
+def parse_faults(spec):
+    # `kind:probability[@start-end]` items separated by commas, e.g.
+    # `5xx:0.05,reset:0.01@10-60,stall:0.01@30-`. For `gc` the value is
+    # `interval/duration` in seconds instead of a probability, e.g. `gc:5/0.5`.
+    # The optional window is given in seconds since the server started.
+    faults = []
+    for item in filter(None, (item.strip() for item in (spec or '').split(','))):
+        kind, value = item.split(':', 1)
+        if kind not in FAULT_KINDS:
+            raise ValueError(f'Unknown fault `{kind}`, expected one of {FAULT_KINDS}.')
+        value, _, window = value.partition('@')
+        start, _, end = window.partition('-')
+        fault = {
+            'kind': kind,
+            'start': float(start) if start else 0.0,
+            'end': float(end) if end else float('inf'),
+        }
+        if kind == 'gc':
+            interval, duration = value.split('/')
+            fault['interval'] = float(interval)
+            fault['duration'] = float(duration)
+        else:
+            fault['prob'] = float(value)
+        faults.append(fault)
+    return faults
+
+
+def in_window(app, fault):
+    elapsed = time.time() - app['start_time']
+    return fault['start'] <= elapsed < fault['end']
+
+
+def pick_fault(app):
+    for fault in app['faults']:
+        if fault['kind'] != 'gc' and in_window(app, fault) and app['rng'].random() < fault['prob']:
+            app['fault_counts'][fault['kind']] += 1
+            return fault['kind']
+    return None
+
+
+async def apply_fault(request, fault):
+    # Returns a response that replaces the normal answer, if any.
+    if fault == '5xx':
+        return web.Response(status=503, text='Injected fault: service unavailable.')
+    elif fault == 'reset':
+        request.transport.abort()
+        return web.Response()
+    elif fault == 'stall':
+        await asyncio.sleep(request.app['stall_time'])
+        return web.Response(status=504, text='Injected fault: stalled.')
+    return None
+
+
+def token_delay(request, fault):
+    return request.app['drip_interval'] if fault == 'drip' else 0
+
+
+async def gc_pauses(app, fault):
+    # Stop-the-world pauses: the event loop is blocked, so in-flight streams
+    # and new connections all freeze, like a garbage collection of the server.
+    while True:
+        await asyncio.sleep(fault['interval'])
+        if in_window(app, fault):
+            app['fault_counts']['gc'] += 1
+            time.sleep(fault['duration'])
+
+
+async def start_gc_pauses(app):
+    app['gc_tasks'] = [
+        asyncio.create_task(gc_pauses(app, fault))
+        for fault in app['faults'] if fault['kind'] == 'gc'
+    ]
+
+
+async def stop_gc_pauses(app):
+    for task in app['gc_tasks']:
+        task.cancel()
+
+
+async def vllm_generate(request):
+    data = await request.json()
+    fault = pick_fault(request.app)
+    response = await apply_fault(request, fault)
+    if response is not None:
+        return response
+    delay = token_delay(request, fault)
+    prompt = data['prompt']
+    max_tokens = data.get('max_tokens', 16)
+    n = data.get('n', 1)
+    if not data.get('stream'):
+        await asyncio.sleep(delay * max_tokens)
+        return web.json_response({'text': [prompt + completion(max_tokens)] * n})
+    response = web.StreamResponse()
+    await response.prepare(request)
+    for i in range(1, max_tokens + 1):
+        await asyncio.sleep(delay)
+        chunk = json.dumps({'text': [prompt + completion(i)] * n}).encode('utf-8') + b'\0'
+        await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+async def mii_generate(request):
+    data = await request.json()
+    fault = pick_fault(request.app)
+    response = await apply_fault(request, fault)
+    if response is not None:
+        return response
+    max_tokens = data.get('max_new_tokens', 16)
+    await asyncio.sleep(token_delay(request, fault) * max_tokens)
+    return web.json_response([
+        {'generated_text': completion(max_tokens), 'generated_length': max_tokens}
+        for _ in data['prompts']
+    ])
+
+
+async def llama_cpp_completion(request):
+    data = await request.json()
+    fault = pick_fault(request.app)
+    response = await apply_fault(request, fault)
+    if response is not None:
+        return response
+    delay = token_delay(request, fault)
+    max_tokens = data.get('n_predict', 16)
+    if not data.get('stream'):
+        await asyncio.sleep(delay * max_tokens)
+        return web.json_response({'content': completion(max_tokens), 'stop': True})
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+    await response.prepare(request)
+    for i in range(max_tokens):
+        await asyncio.sleep(delay)
+        message = {'content': TOKEN, 'stop': i + 1 == max_tokens}
+        await response.write(b'data: ' + json.dumps(message).encode('utf-8') + b'\n\n')
+    await response.write_eof()
+    return response
+
+
+async def fault_stats(request):
+    return web.json_response(request.app['fault_counts'])
+
+
+def create_app(faults=None, drip_interval=0.05, stall_time=3600.0, seed=0):
+    app = web.Application()
+    app['faults'] = parse_faults(faults)
+    app['drip_interval'] = drip_interval
+    app['stall_time'] = stall_time
+    app['rng'] = random.Random(seed)
+    app['start_time'] = time.time()
+    app['fault_counts'] = {kind: 0 for kind in FAULT_KINDS}
+    app.on_startup.append(start_gc_pauses)
+    app.on_cleanup.append(stop_gc_pauses)
+    app.router.add_post('/generate', vllm_generate)
+    app.router.add_post('/mii/{deployment}', mii_generate)
+    app.router.add_post('/completion', llama_cpp_completion)
+    app.router.add_get('/fault_stats', fault_stats)
+    return app
+
+
+def get_api_url(backend, host, port):
+    if backend == 'vllm':
+        return f'http://{host}:{port}/generate'
+    elif backend == 'mii':
+        return f'http://{host}:{port}/mii/mock'
+    elif backend == 'llama.cpp':
+        return f'http://{host}:{port}/completion'
+    else:
+        raise NotImplementedError
+
+
+async def start_server(host, port, **app_kwargs):
+    runner = web.AppRunner(create_app(**app_kwargs), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    # Resolve the actual port when an ephemeral port (0) is requested.
+    port = runner.addresses[0][1]
+    return runner, port
+
+
+async def serve(args):
+    runner, port = await start_server(
+        args.host, args.port,
+        faults=args.faults, drip_interval=args.drip_interval, stall_time=args.stall_time, seed=args.seed,
+    )
+    print(f'Mock server is listening on {args.host}:{port}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(f'Injected faults: {runner.app["fault_counts"]}')
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Address the mock server listens on."
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8000,
+        help="Port the mock server listens on."
+    )
+    parser.add_argument(
+        "--faults",
+        type=str,
+        default=None,
+        help="Faults to inject, e.g. `5xx:0.05,reset:0.01,drip:0.02@10-60,stall:0.01,gc:5/0.5`. "
+            "Each item is `kind:probability[@start-end]` (`kind:interval/duration` for gc), "
+            "the window being seconds since the server started.",
+    )
+    parser.add_argument(
+        "--drip_interval",
+        type=float,
+        default=0.05,
+        help="Seconds between two tokens of a slow-drip response."
+    )
+    parser.add_argument(
+        "--stall_time",
+        type=float,
+        default=3600.0,
+        help="Seconds a stalled request waits before the server gives up on it."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed of the fault injection."
+    )
+    args = parser.parse_args()
+
+    asyncio.run(serve(args))
@@ -0,0 +1,208 @@
+import os
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+import time
+
+
+# A local store of benchmark results, written by batching_inference.py and
+# serving_inference.py next to their JSON outputs.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    script TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    backend TEXT,
+    model TEXT,
+    dataset TEXT,
+    device TEXT,
+    request_rate REAL,
+    output_file TEXT,
+    args TEXT
+);
+CREATE TABLE IF NOT EXISTS rounds (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    phase TEXT NOT NULL,
+    round INTEGER NOT NULL,
+    total_time REAL,
+    throughput REAL,
+    generated_tokens INTEGER,
+    avg_latency REAL,
+    metrics TEXT,
+    PRIMARY KEY (run_id, phase, round)
+);
+CREATE TABLE IF NOT EXISTS requests (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    phase TEXT NOT NULL,
+    round INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    scheduled_time REAL,
+    start_time REAL,
+    first_token_time REAL,
+    end_time REAL,
+    latency REAL,
+    ttft REAL,
+    prompt_tokens INTEGER,
+    output_tokens INTEGER,
+    status TEXT,
+    retries INTEGER,
+    tenant TEXT,
+    priority INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_backend ON runs(backend);
+CREATE INDEX IF NOT EXISTS runs_model ON runs(model);
+CREATE INDEX IF NOT EXISTS runs_dataset ON runs(dataset);
+CREATE INDEX IF NOT EXISTS runs_device ON runs(device);
+CREATE INDEX IF NOT EXISTS runs_request_rate ON runs(request_rate);
+CREATE INDEX IF NOT EXISTS requests_run ON requests(run_id, phase, round);
+'''
+REQUEST_COLUMNS = [
+    'scheduled_time', 'start_time', 'first_token_time', 'end_time', 'latency', 'ttft',
+    'prompt_tokens', 'output_tokens', 'status', 'retries', 'tenant', 'priority',
+]
+FILTERS = ['backend', 'model', 'dataset', 'device', 'request_rate']
+
+
+def connect(db_path):
+    if os.path.dirname(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def to_number(value):
+    # numpy scalars are stored as plain Python numbers.
+    return value.item() if hasattr(value, 'item') else value
+
+
+def save_run(db_path, script, run, rounds, requests=()):
+    # `run` holds the indexed metadata, `rounds` is a list of
+    # (phase, round, metrics) and `requests` a list of (phase, round, records).
+    with connect(db_path) as conn:
+        cursor = conn.execute(
+            'INSERT INTO runs (script, created_at, backend, model, dataset, device, request_rate, output_file, args) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                script, time.time(), run.get('backend'), run.get('model'), run.get('dataset'),
+                run.get('device'), run.get('request_rate'), run.get('output_file'),
+                json.dumps(run.get('args')),
+            ),
+        )
+        run_id = cursor.lastrowid
+        conn.executemany(
+            'INSERT INTO rounds VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                (
+                    run_id, phase, round, to_number(metrics.get('total_time')),
+                    to_number(metrics.get('sequence_throughput')), to_number(metrics.get('generated_tokens')),
+                    to_number(metrics.get('avg_latency')), json.dumps(metrics, default=to_number),
+                )
+                for phase, round, metrics in rounds
+            ],
+        )
+        conn.executemany(
+            f'INSERT INTO requests VALUES ({", ".join(["?"] * (len(REQUEST_COLUMNS) + 4))})',
+            [
+                (run_id, phase, round, idx) + tuple(to_number(record.get(key)) for key in REQUEST_COLUMNS)
+                for phase, round, records in requests
+                for idx, record in enumerate(records)
+            ],
+        )
+    conn.close()
+    return run_id
+
+
+def query_runs(conn, args):
+    conditions, params = [], []
+    for key in FILTERS:
+        value = getattr(args, key)
+        if value is not None:
+            conditions.append(f'runs.{key} = ?')
+            params.append(value)
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+    return conn.execute(
+        "SELECT runs.run_id, script, datetime(created_at, 'unixepoch', 'localtime') AS created, "
+        "backend, model, dataset, device, request_rate, COUNT(rounds.round) AS rounds, "
+        "AVG(rounds.throughput) AS throughput, AVG(rounds.avg_latency) AS avg_latency, "
+        "AVG(rounds.total_time) AS total_time, output_file "
+        f"FROM runs LEFT JOIN rounds ON rounds.run_id = runs.run_id AND rounds.phase = 'warm' {where} "
+        "GROUP BY runs.run_id ORDER BY runs.run_id",
+        params,
+    ).fetchall()
+
+
+def write_rows(rows, output_format, f):
+    if output_format == 'json':
+        json.dump([dict(row) for row in rows], f, indent=2)
+        f.write('\n')
+        return
+    writer = csv.writer(f, delimiter='\t' if output_format == 'table' else ',')
+    if rows:
+        writer.writerow(rows[0].keys())
+    for row in rows:
+        writer.writerow(list(row))
+
+
+def main(args):
+    conn = connect(args.db)
+    if args.command == 'runs':
+        rows = query_runs(conn, args)
+    elif args.command == 'rounds':
+        rows = conn.execute(
+            'SELECT * FROM rounds WHERE run_id = ? ORDER BY phase, round', (args.run_id,)
+        ).fetchall()
+    elif args.command == 'requests':
+        rows = conn.execute(
+            'SELECT * FROM requests WHERE run_id = ? ORDER BY phase, round, idx', (args.run_id,)
+        ).fetchall()
+    else:
+        rows = conn.execute(args.query).fetchall()
+    if args.output is None:
+        write_rows(rows, args.format, sys.stdout)
+    else:
+        with open(args.output, 'w', newline='') as f:
+            write_rows(rows, args.format, f)
+        print(f'{len(rows)} rows are saved in {args.output}')
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--db",
+        type=str,
+        default="output/results.db",
+        help="Path of the results database."
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="table",
+        choices=["table", "csv", "json"],
+        help="Output format."
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="If specified, the result is exported to this file instead of printed."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    runs_parser = subparsers.add_parser("runs", help="List runs with their average warm-phase metrics.")
+    runs_parser.add_argument("--backend", type=str, default=None)
+    runs_parser.add_argument("--model", type=str, default=None)
+    runs_parser.add_argument("--dataset", type=str, default=None)
+    runs_parser.add_argument("--device", type=str, default=None)
+    runs_parser.add_argument("--request_rate", type=float, default=None)
+    for command in ["rounds", "requests"]:
+        command_parser = subparsers.add_parser(command, help=f"Export the {command} of a run.")
+        command_parser.add_argument("run_id", type=int)
+    sql_parser = subparsers.add_parser("sql", help="Run an arbitrary SQL query.")
+    sql_parser.add_argument("query", type=str)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,183 @@
+import os
+import argparse
+import asyncio
+import hashlib
+import json
+import threading
+import time
+
+import numpy as np
+
+import mock_server
+import serving_inference
+
+
+# Sources of the client side of the benchmark. The suite is keyed by their
+# hash, so it only runs again when the load generator changes.
+CLIENT_SOURCES = ['serving_inference.py', 'mock_server.py', 'self_benchmark.py']
+
+
+def start_server_thread(host):
+    # The mock server runs on its own event loop in a separate thread, so the
+    # CPU time of the client thread can be measured with `time.thread_time`.
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    server = {}
+
+    def run():
+        asyncio.set_event_loop(loop)
+        server['runner'], server['port'] = loop.run_until_complete(mock_server.start_server(host, 0))
+        started.set()
+        loop.run_forever()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    started.wait()
+    return loop, server['port']
+
+
+def run_client(backend, api_url, request_rate, args):
+    client_args = serving_inference.get_parser().parse_args([
+        '--backend', backend,
+        '--api_url', api_url,
+        '--request_rate', str(request_rate),
+    ])
+    eval_data = [{'prompt': args.prompt, 'max_tokens': args.max_tokens}] * args.num_requests
+    requests = serving_inference.build_requests(eval_data, client_args)
+
+    schedule = serving_inference.build_schedule(len(requests), request_rate)
+    # The Poisson arrivals of a finite schedule drift from the nominal rate,
+    # the client is judged against the rate of the schedule it was given.
+    scheduled_rate = (len(schedule) - 1) / schedule[-1] if schedule[-1] > 0 else float('inf')
+
+    cpu_start_time = time.thread_time()
+    outputs = asyncio.run(serving_inference.benchmark(requests, client_args, schedule))
+    cpu_time = time.thread_time() - cpu_start_time
+
+    start_time = [output['start_time'] for output in outputs]
+    jitter = np.array([output['start_time'] - output['scheduled_time'] for output in outputs])
+    achieved_rate = (len(outputs) - 1) / (max(start_time) - min(start_time))
+    result = {
+        'backend': backend,
+        'target_rate': request_rate,
+        'scheduled_rate': scheduled_rate,
+        'achieved_rate': achieved_rate,
+        'cpu_time_per_request': cpu_time / len(outputs),
+        'avg_jitter': float(np.mean(jitter)),
+        'p50_jitter': float(np.percentile(jitter, 50)),
+        'p99_jitter': float(np.percentile(jitter, 99)),
+        'max_jitter': float(np.max(jitter)),
+    }
+    result['sustainable'] = bool(
+        request_rate != float('inf')
+        and achieved_rate >= (1 - args.rate_tolerance) * scheduled_rate
+        and result['p99_jitter'] * 1000 <= args.max_jitter
+    )
+    return result
+
+
+def print_results(results):
+    print(f'{"backend":<10} {"target":>8} {"schedule":>9} {"achieved":>9} {"cpu/req":>9} '
+        f'{"p50 jit":>9} {"p99 jit":>9} {"max jit":>9}  ok')
+    for result in results:
+        print(f'{result["backend"]:<10} {result["target_rate"]:>8.0f} {result["scheduled_rate"]:>9.1f} '
+            f'{result["achieved_rate"]:>9.1f} '
+            f'{result["cpu_time_per_request"] * 1000:>7.3f}ms '
+            f'{result["p50_jitter"] * 1000:>7.3f}ms {result["p99_jitter"] * 1000:>7.3f}ms '
+            f'{result["max_jitter"] * 1000:>7.3f}ms  {"y" if result["sustainable"] else "n"}')
+    print()
+    for backend in dict.fromkeys(result['backend'] for result in results):
+        sustainable = [
+            result['target_rate'] for result in results
+            if result['backend'] == backend and result['sustainable']
+        ]
+        ceiling = max(sustainable) if sustainable else 0
+        print(f'{backend}: max sustainable dispatch rate = {ceiling:.0f} requests/s')
+
+
+def main(args):
+    md5 = hashlib.md5(json.dumps(vars(args), sort_keys=True).encode('utf-8'))
+    for source in CLIENT_SOURCES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), source), 'rb') as f:
+            md5.update(f.read())
+    output_file = f'output/self_benchmark/{md5.hexdigest()}.json'
+    if os.path.exists(output_file) and not args.force:
+        print(f'The client code is unchanged, reusing {output_file}')
+        with open(output_file, 'r') as f:
+            print_results(json.load(f)['results'])
+        return
+
+    loop, port = start_server_thread(args.host)
+    results = []
+    for backend in args.backends.split(','):
+        api_url = mock_server.get_api_url(backend, args.host, port)
+        for request_rate in args.request_rates.split(','):
+            print(f'{backend} @ {request_rate} requests/s:')
+            results.append(run_client(backend, api_url, float(request_rate), args))
+    loop.call_soon_threadsafe(loop.stop)
+    print_results(results)
+
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    print(f'The result will be saved in {output_file}')
+    with open(output_file, 'w') as f:
+        json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--backends",
+        type=str,
+        default="vllm,mii,llama.cpp",
+        help="Comma separated backend adapters to benchmark."
+    )
+    parser.add_argument(
+        "--request_rates",
+        type=str,
+        default="250,500,1000,2000,4000,8000,inf",
+        help="Comma separated target dispatch rates (requests per second)."
+    )
+    parser.add_argument(
+        "--num_requests",
+        type=int,
+        default=2000,
+        help="Number of requests sent at each rate."
+    )
+    parser.add_argument(
+        "--prompt",
+        type=str,
+        default="[INST] Hello [/INST]",
+        help="Prompt of every request."
+    )
+    parser.add_argument(
+        "--max_tokens",
+        type=int,
+        default=16,
+        help="Number of tokens returned by the mock server for each request."
+    )
+    parser.add_argument(
+        "--rate_tolerance",
+        type=float,
+        default=0.05,
+        help="A rate is sustainable if the achieved rate is within this fraction of the rate of its arrival schedule."
+    )
+    parser.add_argument(
+        "--max_jitter",
+        type=float,
+        default=10.0,
+        help="A rate is sustainable if the P99 scheduling jitter is below this value (ms)."
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Address the in-process mock server listens on."
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="If given, the suite is run even if the client code is unchanged.",
+    )
+    args = parser.parse_args()
+
+    main(args)
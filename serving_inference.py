@@ -12,69 +12,211 @@ import aiohttp
 import transformers
 import numpy as np
 
+import columnar
+import results_db
 
-# query_start_time = None
-async def vllm_inference(url, prompt, idx, outputs, tqdm_info, **kwargs):
-    headers = {"User-Agent": "Test Client"}
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def use_json_lib(name):
+    global json_dumps, json_loads
+    if name == 'orjson':
+        if orjson is None:
+            raise ImportError('orjson is not installed, please use `--json_lib json`.')
+        json_dumps = orjson.dumps
+        json_loads = orjson.loads
+    else:
+        json_dumps = lambda obj: json.dumps(obj).encode('utf-8')
+        json_loads = json.loads
+
+
+use_json_lib('orjson' if orjson is not None else 'json')
+
+
+def check_sampling_args(args):
+    if args.backend != 'vllm' and (args.n > 1 or args.best_of is not None or args.use_beam_search):
+        raise NotImplementedError(f'Parallel sampling and beam search are not supported by {args.backend}.')
+    # vLLM uses `best_of` (which defaults to `n`) beams, and rejects beam search with a single beam.
+    if args.use_beam_search and (args.best_of or args.n) < 2:
+        raise ValueError('Beam search requires `--best_of` > 1 (or `--n` > 1).')
+    if args.n > 1 and not args.use_beam_search and args.temperature == 0:
+        raise ValueError('Sampling several sequences per prompt requires `--temperature` > 0.')
+
+
+def vllm_request_data(prompt, max_tokens, args):
+    data = {
+        "prompt": prompt,
+        "temperature": args.temperature,
+        "max_tokens": max_tokens,
+    }
+    if args.n > 1:
+        data["n"] = args.n
+    if args.best_of is not None:
+        data["best_of"] = args.best_of
+    if args.use_beam_search:
+        data["use_beam_search"] = True
+    if args.stream:
+        data["stream"] = True
+    if args.ignore_eos:
+        data["ignore_eos"] = True
+    return data
+
+
+def mii_request_data(prompt, max_tokens, args):
+    if args.stream:
+        raise NotImplementedError('The MII RESTful API does not support streaming.')
+    data = {
+        "prompts": [prompt],
+        "do_sample": False,
+        "max_new_tokens": max_tokens,
+    }
+    if args.ignore_eos:
+        data["ignore_eos"] = True
+    return data
+
+
+def llama_cpp_request_data(prompt, max_tokens, args):
     data = {
         "prompt": prompt,
-        "temperature": 0.0,
+        "temperature": 0,
+        "n_predict": max_tokens,
     }
-    data.update(kwargs)
+    if args.stream:
+        data["stream"] = True
+    if args.ignore_eos:
+        # `n_predict` is always set, so ignoring EOS makes llama.cpp generate exactly that many tokens.
+        data["ignore_eos"] = True
+    return data
+
+
+def should_retry(retries, max_retries):
+    # A negative `max_retries` retries forever.
+    return max_retries < 0 or retries < max_retries
+
+
+# query_start_time = None
+async def vllm_inference(url, request, idx, outputs, tqdm_info):
+    headers = {"User-Agent": "Test Client", "Content-Type": "application/json"}
+    prompt = request['prompt']
     start_time = time.time()
+    retries = 0
+    error = None
     async with aiohttp.ClientSession() as session:
-        response = await session.post(url, headers=headers, json=data, timeout=None)
-        data = await response.json()
-        output = data['text'][0][len(prompt):]
-        tqdm_info['bar'].update(1)
+        while True:
+            try:
+                first_token_time = None
+                parse_time = 0
+                response = await session.post(url, headers=headers, data=request['payload'], timeout=tqdm_info['timeout'])
+                response.raise_for_status()
+                if request['stream']:
+                    # The api server streams the full text so far, one JSON per chunk,
+                    # delimited by null bytes.
+                    data = None
+                    buffer = b''
+                    async for chunk in response.content.iter_any():
+                        buffer += chunk
+                        *messages, buffer = buffer.split(b'\0')
+                        parse_start_time = time.time()
+                        for message in messages:
+                            if message:
+                                data = json_loads(message)
+                                if first_token_time is None and len(data['text'][0]) > len(prompt):
+                                    first_token_time = parse_start_time
+                        parse_time += time.time() - parse_start_time
+                    if data is None:
+                        raise ValueError('The stream ended without any output.')
+                else:
+                    body = await response.read()
+                    parse_start_time = time.time()
+                    data = json_loads(body)
+                    parse_time = time.time() - parse_start_time
+                # One text per returned sequence when `n` > 1.
+                sequences = [text[len(prompt):] for text in data['text']]
+                break
+            except Exception as e:
+                if not should_retry(retries, tqdm_info['max_retries']):
+                    error = repr(e)
+                    sequences = ['']
+                    break
+                retries += 1
+    output = sequences[0]
+    tqdm_info['bar'].update(1)
     end_time = time.time()
     request_time = end_time - start_time
     outputs[idx] = {
         'prompt': prompt,
         'output': output,
+        'scheduled_time': request['scheduled_time'],
         'start_time': start_time,
+        'first_token_time': first_token_time,
         'end_time': end_time,
         'latency': request_time,
+        'ttft': None if first_token_time is None else first_token_time - start_time,
+        'parse_time': parse_time,
+        'num_sequences': len(sequences),
+        'status': 'ok' if error is None else 'error',
+        'retries': retries,
+        'error': error,
     }
+    if len(sequences) > 1:
+        outputs[idx]['sequences'] = sequences
 
 
-async def mii_inference(url, prompt, idx, outputs, tqdm_info, **kwargs):
+async def mii_inference(url, request, idx, outputs, tqdm_info):
     headers = {"Content-Type": "application/json"}
-    data = {
-        "prompts": [prompt],
-        "do_sample": False,
-    }
-    data.update(kwargs)
+    prompt = request['prompt']
     start_time = time.time()
+    retries = 0
+    error = None
     while True:
         try:
             async with aiohttp.ClientSession() as session:
-                response = await session.post(url, headers=headers, json=data, timeout=None)
-                data = await response.json()
+                response = await session.post(url, headers=headers, data=request['payload'], timeout=tqdm_info['timeout'])
+                response.raise_for_status()
+                body = await response.read()
+                parse_start_time = time.time()
+                data = json_loads(body)
                 output = data[0]['generated_text']
-                tqdm_info['bar'].update(1)
+                parse_time = time.time() - parse_start_time
             break
         except Exception as e:
+            if not should_retry(retries, tqdm_info['max_retries']):
+                error = repr(e)
+                output = ''
+                parse_time = 0
+                break
+            retries += 1
             continue
+    tqdm_info['bar'].update(1)
     end_time = time.time()
     request_time = end_time - start_time
     outputs[idx] = {
         'prompt': prompt,
         'output': output,
+        'scheduled_time': request['scheduled_time'],
         'start_time': start_time,
+        'first_token_time': None,
         'end_time': end_time,
         'latency': request_time,
+        'ttft': None,
+        'parse_time': parse_time,
+        'num_sequences': 1,
+        'status': 'ok' if error is None else 'error',
+        'retries': retries,
+        'error': error,
     }
 
 
-async def llama_cpp_inference(url, prompt, idx, outputs, tqdm_info, **kwargs):
+async def llama_cpp_inference(url, request, idx, outputs, tqdm_info):
     headers = {"Content-Type": "application/json"}
-    data = {
-        "prompt": prompt,
-        "temperature": 0,
-    }
-    data.update(kwargs)
+    prompt = request['prompt']
     start_time = time.time()
+    retries = 0
+    error = None
     # while True:
     #     try:
     #         async with aiohttp.ClientSession() as session:
@@ -88,27 +230,125 @@ async def llama_cpp_inference(url, prompt, idx, outputs, tqdm_info, **kwargs):
     async with aiohttp.ClientSession() as session:
         while True:
             try:
-                response = await session.post(url, headers=headers, json=data, timeout=None)
-                result = await response.json()
-                output = result['content']
-                tqdm_info['bar'].update(1)
+                first_token_time = None
+                parse_time = 0
+                response = await session.post(url, headers=headers, data=request['payload'], timeout=tqdm_info['timeout'])
+                response.raise_for_status()
+                if request['stream']:
+                    # Server-sent events, each carrying the newly generated piece of text.
+                    pieces = []
+                    stopped = False
+                    async for line in response.content:
+                        if not line.startswith(b'data: '):
+                            continue
+                        parse_start_time = time.time()
+                        result = json_loads(line[len(b'data: '):])
+                        if first_token_time is None and result['content']:
+                            first_token_time = parse_start_time
+                        pieces.append(result['content'])
+                        parse_time += time.time() - parse_start_time
+                        if result.get('stop'):
+                            stopped = True
+                            break
+                    response.release()
+                    if not stopped:
+                        raise ValueError('The stream ended before the stop message.')
+                    output = ''.join(pieces)
+                else:
+                    body = await response.read()
+                    parse_start_time = time.time()
+                    result = json_loads(body)
+                    output = result['content']
+                    parse_time = time.time() - parse_start_time
                 break
             except Exception as e:
                 # print(e)
+                if not should_retry(retries, tqdm_info['max_retries']):
+                    error = repr(e)
+                    output = ''
+                    break
+                retries += 1
                 await asyncio.sleep(0.004)
                 continue
+    tqdm_info['bar'].update(1)
     end_time = time.time()
     request_time = end_time - start_time
     # print(data)
     outputs[idx] = {
         'prompt': prompt,
         'output': output,
+        'scheduled_time': request['scheduled_time'],
         'start_time': start_time,
+        'first_token_time': first_token_time,
         'end_time': end_time,
         'latency': request_time,
+        'ttft': None if first_token_time is None else first_token_time - start_time,
+        'parse_time': parse_time,
+        'num_sequences': 1,
+        'status': 'ok' if error is None else 'error',
+        'retries': retries,
+        'error': error,
     }
 
 
+def get_backend(backend):
+    if backend == 'vllm':
+        return vllm_inference, vllm_request_data
+    elif backend == 'mii':
+        return mii_inference, mii_request_data
+    elif backend == 'llama.cpp':
+        return llama_cpp_inference, llama_cpp_request_data
+    else:
+        raise NotImplementedError
+
+
+def make_request(data, prompt, args):
+    _, request_data_func = get_backend(args.backend)
+    request_data = request_data_func(prompt, data['max_tokens'], args)
+    tenant = data.get('tenant', 'default')
+    priority = data.get('priority', 0)
+    # Forward the labels to the servers (or gateways) that accept them.
+    if args.tenant_field is not None:
+        request_data[args.tenant_field] = tenant
+    if args.priority_field is not None:
+        request_data[args.priority_field] = priority
+    return {
+        'prompt': prompt,
+        'payload': json_dumps(request_data),
+        'stream': args.stream,
+        'tenant': tenant,
+        'priority': priority,
+    }
+
+
+def build_requests(eval_data, args):
+    # Serialize every request body before the timed phase, so that the request
+    # coroutines only have to send pre-built bytes.
+    return [make_request(data, data['prompt'], args) for data in eval_data]
+
+
+def parse_weights(spec, value_type):
+    labels, weights = [], []
+    for item in spec.split(','):
+        label, weight = item.split(':')
+        labels.append(value_type(label))
+        weights.append(float(weight))
+    return labels, weights
+
+
+def assign_labels(eval_data, args):
+    # Examples keep the `tenant` and `priority` fields of the dataset, the
+    # others are drawn from the `--tenants` and `--priorities` mixes.
+    rng = random.Random(args.seed)
+    for key, spec, value_type in [('tenant', args.tenants, str), ('priority', args.priorities, int)]:
+        if spec is None:
+            continue
+        labels, weights = parse_weights(spec, value_type)
+        for data in eval_data:
+            if key not in data:
+                data[key] = rng.choices(labels, weights)[0]
+
+
 def get_eval_data(args):
     if args.data_path is None:
         raise ValueError
@@ -118,70 +358,457 @@ def get_eval_data(args):
         tokenizer = transformers.AutoTokenizer.from_pretrained(args.model_name_or_path, padding_side="left")
         tokenizer.pad_token = tokenizer.unk_token
         tokenizer.pad_token_id = tokenizer.unk_token_id
+    elif 'vicuna' in args.model_name_or_path:
+        tokenizer = transformers.AutoTokenizer.from_pretrained(args.model_name_or_path, padding_side="left")
     else:
         raise NotImplementedError
 
     return eval_data, tokenizer
 
 
-async def benchmark(eval_data, args):
-    iter_data_tqdm = tqdm(total=len(eval_data), desc='Send Requests    ')
-    async def iter_data(max_tokens_name):
-        # start_time = time.time()
-        for i, data in enumerate(eval_data):
-            kwargs = {max_tokens_name: data['max_tokens']}
-            last_time = time.time()
-            iter_data_tqdm.update(1)
-            yield i, data['prompt'], kwargs
-            if args.request_rate == float('inf'):
-                continue
-            interval = np.random.exponential(1.0 / args.request_rate) - (time.time() - last_time)
-            # assert interval > 0, f'{interval}, {(time.time() - last_time)}'
+def get_prompt_lengths(eval_data, tokenizer, args):
+    # Token counts of the prompts are cached per dataset and tokenizer, long
+    # context datasets are slow to tokenize.
+    stat = os.stat(args.data_path)
+    md5sum_of_cache_meta = hashlib.md5(json.dumps(
+        {
+            'data_path': os.path.abspath(args.data_path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'tokenizer': args.model_name_or_path,
+        }
+    ).encode('utf-8')).hexdigest()
+    cache_file = f"output/cache/{md5sum_of_cache_meta}.json"
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    prompt_lengths = list(map(len, tokenizer(
+        [data['prompt'] for data in eval_data],
+        add_special_tokens=True,
+    )['input_ids']))
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file, 'w') as f:
+        json.dump(prompt_lengths, f)
+    return prompt_lengths
+
+
+def truncate_prompt(prompt, prompt_length, budget, tokenizer, args):
+    input_ids = tokenizer(prompt, add_special_tokens=False)['input_ids']
+    # The special tokens (e.g. BOS) are added back by the server.
+    keep = budget - (prompt_length - len(input_ids))
+    input_ids = input_ids[-keep:] if args.truncation_side == 'left' else input_ids[:keep]
+    return tokenizer.decode(input_ids)
+
+
+def apply_length_policy(eval_data, tokenizer, args):
+    if args.max_tokens_policy == 'dataset':
+        missing = sum('max_tokens' not in data for data in eval_data)
+        if missing > 0:
+            raise ValueError(f'{missing} examples have no `max_tokens` field, please choose a `--max_tokens_policy`.')
+    if args.max_tokens_policy == 'context' and args.max_context_len is None:
+        raise ValueError('`--max_tokens_policy context` requires `--max_context_len`.')
+    prompt_lengths = None
+    if args.max_context_len is not None:
+        prompt_lengths = get_prompt_lengths(eval_data, tokenizer, args)
+        # Tokens added by the server (e.g. BOS), which truncation can't remove.
+        num_special_tokens = len(tokenizer('', add_special_tokens=True)['input_ids'])
+
+    rng = np.random.default_rng(args.seed)
+    num_truncated = 0
+    for i, data in enumerate(eval_data):
+        if args.max_tokens_policy == 'fixed':
+            data['max_tokens'] = args.max_new_tokens
+        elif args.max_tokens_policy == 'sampled':
+            # Log-normal output lengths with the given mean (in tokens).
+            mu = np.log(args.max_tokens_mean) - args.max_tokens_sigma ** 2 / 2
+            data['max_tokens'] = int(np.clip(rng.lognormal(mu, args.max_tokens_sigma), 1, args.max_new_tokens))
+        elif args.max_tokens_policy == 'context':
+            data['max_tokens'] = min(args.max_new_tokens, args.max_context_len - prompt_lengths[i])
+        if prompt_lengths is None:
+            continue
+        # Truncate the prompt so that prompt + max_tokens fits the context of the model.
+        budget = args.max_context_len - max(data['max_tokens'], args.min_new_tokens)
+        if budget <= num_special_tokens:
+            raise ValueError(
+                f'max_tokens = {max(data["max_tokens"], args.min_new_tokens)} of example {i} leaves no room for the '
+                f'prompt in a context of {args.max_context_len} tokens, please lower `--max_new_tokens` '
+                'or `--min_new_tokens`.'
+            )
+        if prompt_lengths[i] > budget:
+            data['prompt'] = truncate_prompt(data['prompt'], prompt_lengths[i], budget, tokenizer, args)
+            num_truncated += 1
+        data['max_tokens'] = max(data['max_tokens'], args.min_new_tokens)
+    if prompt_lengths is not None:
+        print(f'Truncated {num_truncated} prompts to fit the context length of {args.max_context_len} tokens')
+
+
+def get_tqdm_info(total, args):
+    if args.max_retries is not None:
+        max_retries = args.max_retries
+    else:
+        # vLLM requests used to fail on the first error, while the MII and
+        # llama.cpp clients retry until the server answers.
+        max_retries = 0 if args.backend == 'vllm' else -1
+    return {
+        'bar': tqdm(total=total, desc='Finished Requests'),
+        'client_num': args.client_num,
+        'max_retries': max_retries,
+        'timeout': None if args.request_timeout is None else aiohttp.ClientTimeout(total=args.request_timeout),
+    }
+
+
+def build_schedule(num_requests, request_rate):
+    # Arrival offsets (in seconds) relative to the start of the round.
+    if request_rate == float('inf'):
+        return [0.0] * num_requests
+    intervals = np.random.exponential(1.0 / request_rate, size=num_requests)
+    intervals[0] = 0.0
+    return np.cumsum(intervals).tolist()
+
+
+async def benchmark(requests, args, schedule=None, start_time=None):
+    if schedule is None:
+        schedule = build_schedule(len(requests), args.request_rate)
+    iter_data_tqdm = tqdm(total=len(requests), desc='Send Requests    ')
+    async def iter_data():
+        base_time = time.time() if start_time is None else start_time
+        for i, (request, offset) in enumerate(zip(requests, schedule)):
+            interval = base_time + offset - time.time()
             if interval > 0:
                 await asyncio.sleep(interval)
-        # print(f'real rate = {1000 / (last_time - start_time)}')
+            iter_data_tqdm.update(1)
+            yield i, dict(request, scheduled_time=base_time + offset)
     tasks = []
-    outputs = [None] * len(eval_data)
-    tqdm_info = {
-        'bar': tqdm(total=len(eval_data), desc='Finished Requests'),
-        'client_num': args.client_num,
-    }
-    if args.backend == 'vllm':
-        reqeust_func = vllm_inference
-        max_tokens_name = 'max_tokens'
-        # kwargs = {
-        #     "max_tokens": args.max_new_tokens,
-        # }
-    elif args.backend == 'mii':
-        reqeust_func = mii_inference
-        max_tokens_name = 'max_new_tokens'
-        # kwargs = {
-        #     "max_length": args.max_new_tokens,
-        # }
-    elif args.backend == 'llama.cpp':
-        reqeust_func = llama_cpp_inference
-        max_tokens_name = 'n_predict'
-    else:
-        raise NotImplementedError
+    outputs = [None] * len(requests)
+    tqdm_info = get_tqdm_info(len(requests), args)
+    reqeust_func, _ = get_backend(args.backend)
 
-    async for idx, prompt, kwargs in iter_data(max_tokens_name):
+    async for idx, request in iter_data():
         task = asyncio.create_task(
-            reqeust_func(args.api_url, prompt, idx, outputs, tqdm_info, **kwargs)
+            reqeust_func(args.api_url, request, idx, outputs, tqdm_info)
         )
         tasks.append(task)
     await asyncio.gather(*tasks)
+    for output, request in zip(outputs, requests):
+        output['tenant'] = request['tenant']
+        output['priority'] = request['priority']
+    return outputs
+
+
+async def run_sequential(requests, args):
+    # One request at a time, so that the latency of each request is not
+    # hidden by queueing behind the others.
+    outputs = [None] * len(requests)
+    tqdm_info = get_tqdm_info(len(requests), args)
+    reqeust_func, _ = get_backend(args.backend)
+    for idx, request in enumerate(requests):
+        await reqeust_func(args.api_url, dict(request, scheduled_time=time.time()), idx, outputs, tqdm_info)
+        outputs[idx]['tenant'] = request['tenant']
+        outputs[idx]['priority'] = request['priority']
+    return outputs
+
+
+async def run_session(session_idx, turns, scheduled_time, outputs, tqdm_info, tokenizer, args):
+    reqeust_func, _ = get_backend(args.backend)
+    history = ''
+    num_truncated = 0
+    for turn, data in enumerate(turns):
+        # Chat traffic resends the whole conversation: the previous prompt and
+        # answer are prepended to the next user message.
+        prompt = history + data['prompt']
+        if args.max_context_len is not None and turn > 0:
+            # The first turn was already truncated by apply_length_policy.
+            prompt_length = len(tokenizer(prompt, add_special_tokens=True)['input_ids'])
+            budget = args.max_context_len - max(data['max_tokens'], args.min_new_tokens)
+            if prompt_length > budget:
+                prompt = truncate_prompt(prompt, prompt_length, budget, tokenizer, args)
+                num_truncated += 1
+        request = dict(make_request(data, prompt, args), scheduled_time=scheduled_time)
+        idx = session_idx * args.num_turns + turn
+        await reqeust_func(args.api_url, request, idx, outputs, tqdm_info)
+        outputs[idx]['session'] = session_idx
+        outputs[idx]['turn'] = turn
+        outputs[idx]['tenant'] = request['tenant']
+        outputs[idx]['priority'] = request['priority']
+        history = prompt + outputs[idx]['output'] + args.turn_separator
+        if turn + 1 < len(turns):
+            if args.think_time_distribution == 'exponential':
+                think_time = np.random.exponential(args.think_time)
+            else:
+                think_time = args.think_time
+            await asyncio.sleep(think_time)
+            scheduled_time = time.time()
+    return num_truncated
+
+
+async def session_benchmark(eval_data, tokenizer, args):
+    num_sessions = len(eval_data) // args.num_turns
+    # Sessions, rather than single requests, arrive at `request_rate`.
+    schedule = build_schedule(num_sessions, args.request_rate)
+    outputs = [None] * (num_sessions * args.num_turns)
+    tqdm_info = get_tqdm_info(len(outputs), args)
+    tasks = []
+    base_time = time.time()
+    for session_idx, offset in enumerate(tqdm(schedule, desc='Start Sessions   ')):
+        interval = base_time + offset - time.time()
+        if interval > 0:
+            await asyncio.sleep(interval)
+        turns = eval_data[session_idx * args.num_turns:(session_idx + 1) * args.num_turns]
+        tasks.append(asyncio.create_task(
+            run_session(session_idx, turns, base_time + offset, outputs, tqdm_info, tokenizer, args)
+        ))
+    num_truncated = sum(await asyncio.gather(*tasks))
+    if args.max_context_len is not None:
+        print(f'Truncated {num_truncated} conversation prompts to fit the context length of {args.max_context_len} tokens')
     return outputs
 
 
+def report_sessions(outputs, args):
+    # Per-turn TTFT (or latency, when not streaming) and the latency of whole
+    # sessions, from the arrival of the session to its last answer. Failed
+    # requests are left out, as in analyze_round.
+    num_turns = args.num_turns
+    metric_name = 'TTFT' if args.stream else 'latency'
+    per_turn = []
+    for turn in range(num_turns):
+        values = [
+            output['ttft'] if args.stream else output['latency']
+            for output in outputs if output['turn'] == turn and output['status'] == 'ok'
+        ]
+        per_turn.append(np.mean(values) if values else float('nan'))
+        print(f"Turn {turn} average {metric_name}: {per_turn[-1] * 1000:.2f} ms ({len(values)} requests)")
+    turns = np.arange(num_turns)
+    fitted = np.isfinite(per_turn)
+    growth = np.polyfit(turns[fitted], np.array(per_turn)[fitted], 1)[0] if fitted.sum() > 1 else float('nan')
+    print(f"Average {metric_name} growth per turn: {growth * 1000:.2f} ms")
+    # Only sessions whose turns all succeeded.
+    session_latency = [
+        outputs[i + num_turns - 1]['end_time'] - outputs[i]['scheduled_time']
+        for i in range(0, len(outputs), num_turns)
+        if all(output['status'] == 'ok' for output in outputs[i:i + num_turns])
+    ]
+    if not session_latency:
+        print('No session succeeded, session latency is not available.')
+        return per_turn, growth, float('nan')
+    print(f"Average session latency: {np.mean(session_latency):.2f} s, "
+        f"P90 = {np.percentile(session_latency, 90):.2f} s ({len(session_latency)} sessions)")
+    return per_turn, growth, np.mean(session_latency)
+
+
+def report_fairness(outputs, outputs_length, total_time):
+    metrics = {}
+    tenants = sorted(set(output['tenant'] for output in outputs))
+    if len(tenants) > 1:
+        # Jain's index is computed over the token rate each tenant's requests
+        # experience (output tokens / latency), 1 meaning equal service.
+        total_tokens = sum(outputs_length)
+        share, service_rate = {}, []
+        for tenant in tenants:
+            tenant_outputs = [
+                (output_len, output) for output_len, output in zip(outputs_length, outputs)
+                if output['tenant'] == tenant
+            ]
+            tokens = sum(output_len for output_len, _ in tenant_outputs)
+            share[tenant] = tokens / total_tokens
+            service_rate.append(np.mean([output_len / output['latency'] for output_len, output in tenant_outputs]))
+            print(f"Tenant {tenant}: {len(tenant_outputs) / total_time:.2f} requests/s, "
+                f"{share[tenant] * 100:.1f}% of generated tokens, {service_rate[-1]:.2f} tokens/s per request")
+        jain_fairness = sum(service_rate) ** 2 / (len(service_rate) * sum(x * x for x in service_rate))
+        print(f"Jain's fairness index: {jain_fairness:.4f}")
+        metrics['tenant_token_share'] = share
+        metrics['jain_fairness'] = jain_fairness
+    priorities = sorted(set(output['priority'] for output in outputs))
+    if len(priorities) > 1:
+        # Smaller values are more important (the vLLM convention).
+        avg_latency = {
+            priority: np.mean([output['latency'] for output in outputs if output['priority'] == priority])
+            for priority in priorities
+        }
+        inflation = {
+            str(priority): avg_latency[priority] / avg_latency[priorities[0]]
+            for priority in priorities
+        }
+        for priority in priorities:
+            print(f"Priority {priority}: average latency {avg_latency[priority] * 1000:.2f} ms "
+                f"({inflation[str(priority)]:.2f}x priority {priorities[0]})")
+        metrics['priority_latency_inflation'] = inflation
+    return metrics
+
+
+def analyze_round(outputs, max_tokens, tokenizer, args):
+    metrics = {}
+    total_time = outputs[-1]['end_time'] - outputs[0]['start_time']
+    print(f'Total time: {total_time:.2f} s')
+    metrics['total_time'] = total_time
+    send_span = outputs[-1]['start_time'] - outputs[0]['start_time']
+    real_request_rate = len(outputs) / send_span if send_span > 0 else float('nan')
+
+    # Failed requests only count towards the error statistics.
+    num_errors = sum(output['status'] != 'ok' for output in outputs)
+    error_rate = num_errors / len(outputs)
+    avg_retries = np.mean([output['retries'] for output in outputs])
+    max_tokens = [num for num, output in zip(max_tokens, outputs) if output['status'] == 'ok']
+    outputs = [output for output in outputs if output['status'] == 'ok']
+    seq_throughput = len(outputs) / total_time
+    print(f'Sequence throughput: {seq_throughput:.2f} requests/s')
+    metrics['sequence_throughput'] = seq_throughput
+    print(f'Real Request rate = {real_request_rate:.2f} requests/s')
+    metrics['real_request_rate'] = real_request_rate
+    print(f'Failed requests: {num_errors} ({error_rate * 100:.2f}%), average retries: {avg_retries:.3f}')
+    metrics['error_rate'] = error_rate
+    metrics['avg_retries'] = avg_retries
+    goodput = sum(
+        args.goodput_latency is None or output['latency'] <= args.goodput_latency
+        for output in outputs
+    ) / total_time
+    print(f'Goodput: {goodput:.2f} requests/s')
+    metrics['goodput'] = goodput
+    if not outputs:
+        # Nothing to measure when every request failed: the latency and token
+        # metrics are NaN and the length and fairness checks are skipped.
+        print('No request succeeded, latency and token metrics are not available.')
+        metrics['generated_tokens'] = 0
+        for key in ['avg_latency', 'avg_latency_per_token', 'avg_latency_per_output_token', 'avg_dispatch_delay', 'avg_parse_time']:
+            metrics[key] = float('nan')
+        if args.stream:
+            metrics['avg_ttft'] = float('nan')
+        return metrics
+
+    prompts_ids = tokenizer(
+        [
+            output['prompt']
+            for output in outputs
+        ],
+        add_special_tokens=False,
+    )['input_ids']
+    outputs_ids = tokenizer(
+        [
+            output['output']
+            for output in outputs
+        ],
+        add_special_tokens=False,
+    )['input_ids']
+    prompts_length = list(map(len, prompts_ids))
+    outputs_length = list(map(len, outputs_ids))
+    first_sequence_length = outputs_length
+    num_sequences = [output['num_sequences'] for output in outputs]
+    if max(num_sequences) > 1:
+        # Count the generated tokens of all sequences returned for a request.
+        sequences_ids = tokenizer(
+            [
+                sequence
+                for output in outputs
+                for sequence in output.get('sequences', [output['output']])
+            ],
+            add_special_tokens=False,
+        )['input_ids']
+        sequences_length = iter(map(len, sequences_ids))
+        outputs_length = [sum(next(sequences_length) for _ in range(num)) for num in num_sequences]
+    for output, prompt_len, output_len in zip(outputs, prompts_length, outputs_length):
+        output['prompt_tokens'] = prompt_len
+        output['output_tokens'] = output_len
+    total_generated_tokens = sum(outputs_length)
+    print(f"Total generated tokens: {total_generated_tokens}")
+    metrics['generated_tokens'] = total_generated_tokens
+    if args.ignore_eos:
+        # The output is re-tokenized on the client side, which may merge or
+        # split a few tokens, hence the tolerance.
+        length_diff = [
+            output_len - num
+            for output_len, num in zip(first_sequence_length, max_tokens)
+        ]
+        mismatch = sum(abs(diff) > args.length_tolerance for diff in length_diff)
+        print(f"Requests not matching max_tokens: {mismatch} / {len(length_diff)}"
+            f" (max |diff| = {max(map(abs, length_diff))} tokens)")
+        metrics['length_mismatch'] = int(mismatch)
+
+    avg_latency = np.mean([output['latency'] for output in outputs])
+    print(f"Average latency: {avg_latency * 1000:.2f} ms")
+    metrics['avg_latency'] = avg_latency
+    avg_per_token_latency = np.mean([
+        output['latency'] / (prompt_len + output_len)
+        for prompt_len, output_len, output in zip(prompts_length, outputs_length, outputs)
+    ])
+    print(f"Average latency per token: {avg_per_token_latency * 1000:.2f} ms")
+    metrics['avg_latency_per_token'] = avg_per_token_latency
+    avg_per_output_token_latency = np.mean([
+        output['latency'] / output_len
+        for output_len, output in zip(outputs_length, outputs)
+    ])
+    print("Average latency per output token: "
+        f"{avg_per_output_token_latency * 1000:.2f} ms")
+    metrics['avg_latency_per_output_token'] = avg_per_output_token_latency
+    if max(num_sequences) > 1:
+        generated_seq_throughput = sum(num_sequences) / total_time
+        print(f"Generated sequence throughput: {generated_seq_throughput:.2f} sequences/s")
+        metrics['generated_sequence_throughput'] = generated_seq_throughput
+        avg_latency_per_sequence = np.mean([
+            output['latency'] / num for num, output in zip(num_sequences, outputs)
+        ])
+        print(f"Average latency per sequence: {avg_latency_per_sequence * 1000:.2f} ms")
+        metrics['avg_latency_per_sequence'] = avg_latency_per_sequence
+
+    avg_dispatch_delay = np.mean([
+        output['start_time'] - output['scheduled_time'] for output in outputs
+    ])
+    print(f"Average dispatch delay: {avg_dispatch_delay * 1000:.3f} ms")
+    metrics['avg_dispatch_delay'] = avg_dispatch_delay
+    avg_parse_time = np.mean([output['parse_time'] for output in outputs])
+    print(f"Average response parse time: {avg_parse_time * 1000:.3f} ms")
+    metrics['avg_parse_time'] = avg_parse_time
+    if args.stream:
+        ttft = [output['ttft'] for output in outputs if output['ttft'] is not None]
+        avg_ttft = np.mean(ttft) if ttft else float('nan')
+        print(f"Average TTFT: {avg_ttft * 1000:.2f} ms")
+        metrics['avg_ttft'] = avg_ttft
+    metrics.update(report_fairness(outputs, outputs_length, total_time))
+    return metrics
+
+
 def main(args):
     random.seed(args.seed)
+    use_json_lib(args.json_lib)
+    check_sampling_args(args)
+    if args.num_turns > 1 and args.workers is not None:
+        raise NotImplementedError('Multi-turn sessions are not supported with distributed workers.')
     eval_data, tokenizer = get_eval_data(args)
+    apply_length_policy(eval_data, tokenizer, args)
+    assign_labels(eval_data, args)
+
+    serialize_start_time = time.time()
+    requests = build_requests(eval_data, args)
+    serialize_time = time.time() - serialize_start_time
+    print(f'Serialized {len(requests)} request payloads with {args.json_lib} '
+        f'in {serialize_time * 1000:.2f} ms')
 
     detailed_log = {
         'args': vars(args),
         'version': 'v4.1',
         'outputs': [],
+        'phases': {},
     }
+    max_tokens = [data['max_tokens'] for data in eval_data]
+
+    # The cold probe measures the first requests a freshly started server sees
+    # (CUDA graphs, allocator and prefix cache are cold), the warm-up brings the
+    # server to its steady state before the measured rounds.
+    if args.cold_probe_requests > 0:
+        print('Cold probe phase:')
+        outputs = asyncio.run(run_sequential(requests[:args.cold_probe_requests], args))
+        print(f"First request latency: {outputs[0]['latency'] * 1000:.2f} ms")
+        metrics = analyze_round(outputs, max_tokens[:args.cold_probe_requests], tokenizer, args)
+        detailed_log['phases']['cold_probe'] = {'outputs': outputs, 'metrics': metrics}
+        print()
+    if args.warmup_requests > 0:
+        print('Warm-up phase (not measured):')
+        warmup_requests = [requests[i % len(requests)] for i in range(args.warmup_requests)]
+        outputs = asyncio.run(benchmark(warmup_requests, args))
+        metrics = analyze_round(
+            outputs, [max_tokens[i % len(requests)] for i in range(args.warmup_requests)], tokenizer, args
+        )
+        detailed_log['phases']['warmup'] = {'outputs': outputs, 'metrics': metrics}
+        print()
+
     profile_log = {
         'total_time': [],
         'sequence_throughput': [],
@@ -190,63 +817,44 @@ def main(args):
         'avg_latency': [],
         'avg_latency_per_token': [],
         'avg_latency_per_output_token': [],
+        'avg_dispatch_delay': [],
+        'avg_parse_time': [],
+        'avg_ttft': [],
+        'avg_turn_latency': [],
+        'turn_latency_growth': [],
+        'avg_session_latency': [],
+        'length_mismatch': [],
+        'generated_sequence_throughput': [],
+        'avg_latency_per_sequence': [],
+        'error_rate': [],
+        'avg_retries': [],
+        'goodput': [],
+        'tenant_token_share': [],
+        'jain_fairness': [],
+        'priority_latency_inflation': [],
     }
+    round_metrics = []
     for round in range(args.repeat_count):
         print(f'Round {round}:')
-        outputs = asyncio.run(benchmark(eval_data, args))
+        if args.num_turns > 1:
+            outputs = asyncio.run(session_benchmark(eval_data, tokenizer, args))
+        elif args.workers is not None:
+            import distributed_client
+            outputs = asyncio.run(distributed_client.coordinate(requests, args))
+        else:
+            outputs = asyncio.run(benchmark(requests, args))
         detailed_log['outputs'].append(outputs)
 
-        total_time = outputs[-101]['end_time'] - outputs[100]['start_time']
-        print(f'Total time: {total_time:.2f} s')
-        seq_throughput = (len(eval_data) - 200) / total_time
-        print(f'Sequence throughput: {seq_throughput:.2f} requests/s')
-        profile_log['total_time'].append(total_time)
-        profile_log['sequence_throughput'].append(seq_throughput)
-        real_request_rate = (len(eval_data) - 200) / (outputs[-101]['start_time'] - outputs[100]['start_time'])
-        print(f'Real Request rate = {real_request_rate:.2f} requests/s')
-        profile_log['real_request_rate'].append(real_request_rate)
-
-        middle_slice = slice(100, -100)
-        prompts_ids = tokenizer(
-            [
-                output['prompt']
-                for output in outputs
-            ],
-            add_special_tokens=False,
-        )['input_ids']
-        outputs_ids = tokenizer(
-            [
-                output['output']
-                for output in outputs
-            ],
-            add_special_tokens=False,
-        )['input_ids']
-        prompts_length = list(map(len, prompts_ids))
-        outputs_length = list(map(len, outputs_ids))
-        total_generated_tokens = sum(outputs_length[middle_slice])
-        print(f"Total generated tokens: {total_generated_tokens}")
-        profile_log['generated_tokens'].append(total_generated_tokens)
-
-        avg_latency = np.mean([output['latency'] for output in outputs[middle_slice]])
-        print(f"Average latency: {avg_latency * 1000:.2f} ms")
-        profile_log['avg_latency'].append(avg_latency)
-        avg_per_token_latency = np.mean([
-            output['latency'] / (prompt_len + output_len)
-            for prompt_len, output_len, output in zip(
-                prompts_length[middle_slice], outputs_length[middle_slice], outputs[middle_slice]
-            )
-        ])
-        print(f"Average latency per token: {avg_per_token_latency * 1000:.2f} ms")
-        profile_log['avg_latency_per_token'].append(avg_per_token_latency)
-        avg_per_output_token_latency = np.mean([
-            output['latency'] / output_len
-            for output_len, output in zip(
-                outputs_length[middle_slice], outputs[middle_slice]
-            )
-        ])
-        print("Average latency per output token: "
-            f"{avg_per_output_token_latency * 1000:.2f} ms")
-        profile_log['avg_latency_per_output_token'].append(avg_per_output_token_latency)
+        middle_slice = slice(args.trim, len(outputs) - args.trim)
+        metrics = analyze_round(outputs[middle_slice], max_tokens[:len(outputs)][middle_slice], tokenizer, args)
+        round_metrics.append(metrics)
+        for key, value in metrics.items():
+            profile_log[key].append(value)
+        if args.num_turns > 1:
+            per_turn, growth, avg_session_latency = report_sessions(outputs, args)
+            profile_log['avg_turn_latency'].append(per_turn)
+            profile_log['turn_latency_growth'].append(growth)
+            profile_log['avg_session_latency'].append(avg_session_latency)
         print()
 
     print('Summary:')
@@ -256,6 +864,12 @@ def main(args):
         f' ± {np.std(profile_log["total_time"]):.2f} s')
     print(f'Sequence throughput: {np.mean(profile_log["sequence_throughput"]):.2f}'
         f' ± {np.std(profile_log["sequence_throughput"]):.2f} requests/s')
+    print(f'Error rate: {np.mean(profile_log["error_rate"]) * 100:.2f}'
+        f' ± {np.std(profile_log["error_rate"]) * 100:.2f} %')
+    print(f'Average retries: {np.mean(profile_log["avg_retries"]):.3f}'
+        f' ± {np.std(profile_log["avg_retries"]):.3f}')
+    print(f'Goodput: {np.mean(profile_log["goodput"]):.2f}'
+        f' ± {np.std(profile_log["goodput"]):.2f} requests/s')
     print(f'Total generated tokens: {np.mean(profile_log["generated_tokens"]):.2f}'
         f' ± {np.std(profile_log["generated_tokens"]):.2f}')
     print(f'Average latency: {np.mean(profile_log["avg_latency"]):.2f}'
@@ -264,6 +878,58 @@ def main(args):
         f' ± {np.std(profile_log["avg_latency_per_token"]) * 1000:.2f} ms')
     print(f'Average latency per output token: {np.mean(profile_log["avg_latency_per_output_token"]) * 1000:.2f}'
         f' ± {np.std(profile_log["avg_latency_per_output_token"]) * 1000:.2f} ms')
+    print(f'Average dispatch delay: {np.mean(profile_log["avg_dispatch_delay"]) * 1000:.3f}'
+        f' ± {np.std(profile_log["avg_dispatch_delay"]) * 1000:.3f} ms')
+    print(f'Average response parse time: {np.mean(profile_log["avg_parse_time"]) * 1000:.3f}'
+        f' ± {np.std(profile_log["avg_parse_time"]) * 1000:.3f} ms')
+    if profile_log["generated_sequence_throughput"]:
+        print(f'Generated sequence throughput: {np.mean(profile_log["generated_sequence_throughput"]):.2f}'
+            f' ± {np.std(profile_log["generated_sequence_throughput"]):.2f} sequences/s')
+        print(f'Average latency per sequence: {np.mean(profile_log["avg_latency_per_sequence"]) * 1000:.2f}'
+            f' ± {np.std(profile_log["avg_latency_per_sequence"]) * 1000:.2f} ms')
+    if profile_log['jain_fairness']:
+        for tenant in profile_log['tenant_token_share'][0]:
+            share = [round_share[tenant] for round_share in profile_log['tenant_token_share']]
+            print(f'Tenant {tenant} token share: {np.mean(share) * 100:.1f} ± {np.std(share) * 100:.1f} %')
+        print(f"Jain's fairness index: {np.mean(profile_log['jain_fairness']):.4f}"
+            f" ± {np.std(profile_log['jain_fairness']):.4f}")
+    if profile_log['priority_latency_inflation']:
+        for priority in profile_log['priority_latency_inflation'][0]:
+            inflation = [round_inflation[priority] for round_inflation in profile_log['priority_latency_inflation']]
+            print(f'Priority {priority} latency inflation: {np.mean(inflation):.2f}'
+                f' ± {np.std(inflation):.2f}x')
+    if args.ignore_eos:
+        if not profile_log["length_mismatch"]:
+            print('Output lengths were not checked, no request succeeded.')
+        elif sum(profile_log["length_mismatch"]) > 0:
+            print(f'WARNING: output lengths do not match max_tokens (± {args.length_tolerance} tokens) '
+                f'for {sum(profile_log["length_mismatch"])} requests over {len(profile_log["length_mismatch"])} rounds '
+                f'({", ".join(map(str, profile_log["length_mismatch"]))} per round), '
+                'throughput is not comparable across backends.')
+        else:
+            print(f'All output lengths match max_tokens (± {args.length_tolerance} tokens).')
+    if args.stream:
+        print(f'Average TTFT: {np.mean(profile_log["avg_ttft"]) * 1000:.2f}'
+            f' ± {np.std(profile_log["avg_ttft"]) * 1000:.2f} ms')
+    if args.num_turns > 1:
+        per_turn_mean = np.mean(profile_log["avg_turn_latency"], axis=0)
+        print('Average per-turn ' + ('TTFT' if args.stream else 'latency') + ': '
+            + ', '.join(f'{value * 1000:.2f}' for value in per_turn_mean) + ' ms')
+        print(f'Growth per turn: {np.mean(profile_log["turn_latency_growth"]) * 1000:.2f}'
+            f' ± {np.std(profile_log["turn_latency_growth"]) * 1000:.2f} ms')
+        print(f'Average session latency: {np.mean(profile_log["avg_session_latency"]):.2f}'
+            f' ± {np.std(profile_log["avg_session_latency"]):.2f} s')
+
+    if 'cold_probe' in detailed_log['phases']:
+        cold_metrics = detailed_log['phases']['cold_probe']['metrics']
+        cold_outputs = detailed_log['phases']['cold_probe']['outputs']
+        print(f'Cold probe first request latency: {cold_outputs[0]["latency"] * 1000:.2f} ms')
+        print(f'Cold probe average latency: {cold_metrics["avg_latency"] * 1000:.2f} ms '
+            f'({cold_metrics["avg_latency"] / np.mean(profile_log["avg_latency"]):.2f}x the warm phase)')
+        if args.stream:
+            print(f'Cold probe average TTFT: {cold_metrics["avg_ttft"] * 1000:.2f} ms '
+                f'({cold_metrics["avg_ttft"] / np.mean(profile_log["avg_ttft"]):.2f}x the warm phase)')
+    detailed_log['phases']['warm'] = {'metrics': profile_log}
 
     md5sum_of_log_meta = hashlib.md5(json.dumps(
         {
@@ -272,11 +938,49 @@ def main(args):
         }
     ).encode('utf-8')).hexdigest()
     output_file = f"output/benchmark/{md5sum_of_log_meta}.json"
+    request_log = [('warm', round, outputs) for round, outputs in enumerate(detailed_log['outputs'])]
+    for phase in ['cold_probe', 'warmup']:
+        if phase in detailed_log['phases']:
+            request_log.append((phase, 0, detailed_log['phases'][phase]['outputs']))
+    if args.request_log_format == 'columnar':
+        # The JSON keeps the metrics only, the per-request records are stored
+        # as columns in a directory next to it.
+        columns_dir = f"output/benchmark/{md5sum_of_log_meta}"
+        columnar.write_columns(columns_dir, request_log, save_texts=args.save_texts)
+        print(f'The per-request records are saved in {columns_dir}')
+        json_log = dict(
+            detailed_log,
+            outputs=[],
+            columns=md5sum_of_log_meta,
+            phases={phase: {'metrics': log['metrics']} for phase, log in detailed_log['phases'].items()},
+        )
+    else:
+        json_log = detailed_log
     with open(output_file, 'w') as f:
-        json.dump(detailed_log, f)
+        json.dump(json_log, f)
+
+    if args.results_db:
+        rounds = [('warm', round, metrics) for round, metrics in enumerate(round_metrics)]
+        for phase in ['cold_probe', 'warmup']:
+            if phase in detailed_log['phases']:
+                rounds.append((phase, 0, detailed_log['phases'][phase]['metrics']))
+        run_id = results_db.save_run(
+            args.results_db, 'serving',
+            {
+                'backend': args.backend,
+                'model': args.model_name_or_path,
+                'dataset': os.path.split(args.data_path)[-1],
+                'device': args.device_name,
+                'request_rate': args.request_rate,
+                'output_file': output_file,
+                'args': detailed_log['args'],
+            },
+            rounds, request_log,
+        )
+        print(f'The run is recorded in {args.results_db} with run_id {run_id}')
 
 
-if __name__ == '__main__':
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--seed",
@@ -326,6 +1030,70 @@ if __name__ == '__main__':
         default=4096,
         help="Maximum number of new tokens to generate."
     )
+    parser.add_argument(
+        "--max_tokens_policy",
+        type=str,
+        default="dataset",
+        choices=["dataset", "fixed", "sampled", "context"],
+        help="How max_tokens is chosen: the `max_tokens` field of the dataset, `max_new_tokens`, "
+            "sampled from a log-normal distribution, or the context budget left by the prompt.",
+    )
+    parser.add_argument(
+        "--max_tokens_mean",
+        type=float,
+        default=256,
+        help="Mean of the sampled max_tokens with `--max_tokens_policy sampled`."
+    )
+    parser.add_argument(
+        "--max_tokens_sigma",
+        type=float,
+        default=0.5,
+        help="Sigma of the log-normal distribution with `--max_tokens_policy sampled`."
+    )
+    parser.add_argument(
+        "--max_context_len",
+        type=int,
+        default=None,
+        help="If specified, prompts are truncated so that prompt + max_tokens fits this context length."
+    )
+    parser.add_argument(
+        "--min_new_tokens",
+        type=int,
+        default=1,
+        help="Minimum number of tokens left for the output when truncating prompts."
+    )
+    parser.add_argument(
+        "--truncation_side",
+        type=str,
+        default="left",
+        choices=["left", "right"],
+        help="Side of the prompt removed by truncation."
+    )
+    parser.add_argument(
+        "--device_name",
+        type=str,
+        default=None,
+        help="Device of the server, recorded in the results database."
+    )
+    parser.add_argument(
+        "--request_log_format",
+        type=str,
+        default="json",
+        choices=["json", "columnar"],
+        help="Format of the per-request records. `columnar` stores the numeric fields as .npy columns "
+            "in output/benchmark/<md5>/ and keeps only the metrics in the JSON file.",
+    )
+    parser.add_argument(
+        "--save_texts",
+        action="store_true",
+        help="With the columnar format, also save the prompts and outputs in texts.jsonl.",
+    )
+    parser.add_argument(
+        "--results_db",
+        type=str,
+        default="output/results.db",
+        help="SQLite database the run is recorded in. Pass an empty string to disable.",
+    )
     parser.add_argument(
         "--client_num",
         type=int,
@@ -338,6 +1106,163 @@ if __name__ == '__main__':
         default=float('inf'),
         help="Number of requests per second."
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--json_lib",
+        type=str,
+        default="orjson" if orjson is not None else "json",
+        choices=["orjson", "json"],
+        help="JSON library used to encode requests and decode responses."
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="If given, responses are streamed and the time to first token is recorded (vllm and llama.cpp).",
+    )
+    parser.add_argument(
+        "--tenants",
+        type=str,
+        default=None,
+        help="Tenant mix of the examples without a `tenant` field, e.g. `a:0.7,b:0.3`."
+    )
+    parser.add_argument(
+        "--priorities",
+        type=str,
+        default=None,
+        help="Priority mix of the examples without a `priority` field, e.g. `0:0.2,1:0.8`. "
+            "Smaller values are more important.",
+    )
+    parser.add_argument(
+        "--tenant_field",
+        type=str,
+        default=None,
+        help="If specified, the tenant is sent in this request field (e.g. `user`)."
+    )
+    parser.add_argument(
+        "--priority_field",
+        type=str,
+        default=None,
+        help="If specified, the priority is sent in this request field (e.g. `priority`)."
+    )
+    parser.add_argument(
+        "--trim",
+        type=int,
+        default=100,
+        help="Number of requests ignored at the start and the end of every measured round."
+    )
+    parser.add_argument(
+        "--cold_probe_requests",
+        type=int,
+        default=0,
+        help="Number of requests sent one at a time before anything else, measured as the cold phase."
+    )
+    parser.add_argument(
+        "--warmup_requests",
+        type=int,
+        default=0,
+        help="Number of requests sent at `request_rate` before the measured rounds, not measured."
+    )
+    parser.add_argument(
+        "--request_timeout",
+        type=float,
+        default=None,
+        help="Timeout of a single request attempt in seconds. No timeout by default."
+    )
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        default=None,
+        help="Number of retries of a failed request, negative means unlimited. "
+            "By default vllm requests are not retried and mii/llama.cpp requests are retried forever.",
+    )
+    parser.add_argument(
+        "--goodput_latency",
+        type=float,
+        default=None,
+        help="If specified, only successful requests finishing within this latency (s) count towards goodput.",
+    )
+    parser.add_argument(
+        "--ignore_eos",
+        action="store_true",
+        help="If given, the server keeps generating after EOS so that every request produces exactly max_tokens tokens.",
+    )
+    parser.add_argument(
+        "--length_tolerance",
+        type=int,
+        default=1,
+        help="Tolerated difference (in tokens) between the re-tokenized output and max_tokens with `--ignore_eos`."
+    )
+    parser.add_argument(
+        "--n",
+        type=int,
+        default=1,
+        help="Number of output sequences returned for each prompt (vllm)."
+    )
+    parser.add_argument(
+        "--best_of",
+        type=int,
+        default=None,
+        help="Number of sequences generated for each prompt, from which the best `n` are returned (vllm)."
+    )
+    parser.add_argument(
+        "--use_beam_search",
+        action="store_true",
+        help="If given, beam search with `best_of` beams is used instead of sampling (vllm).",
+    )
+    parser.add_argument(
+        "--temperature",
+        type=float,
+        default=0.0,
+        help="Sampling temperature of vllm requests, 0 means greedy decoding."
+    )
+    parser.add_argument(
+        "--num_turns",
+        type=int,
+        default=1,
+        help="Number of turns of each conversation. If larger than 1, consecutive examples form a "
+            "session whose prompts contain the previous prompts and outputs.",
+    )
+    parser.add_argument(
+        "--think_time",
+        type=float,
+        default=0.0,
+        help="Seconds a virtual user waits between receiving an answer and sending the next turn."
+    )
+    parser.add_argument(
+        "--think_time_distribution",
+        type=str,
+        default="fixed",
+        choices=["fixed", "exponential"],
+        help="If exponential, think times are drawn with mean `think_time`."
+    )
+    parser.add_argument(
+        "--turn_separator",
+        type=str,
+        default=" ",
+        help="Text inserted between the previous output and the next user prompt."
+    )
+    parser.add_argument(
+        "--workers",
+        type=str,
+        default=None,
+        help="Comma separated `host:port` list of load generation workers started by "
+            "`distributed_client.py`. If specified, the requests are sent by these workers.",
+    )
+    parser.add_argument(
+        "--start_delay",
+        type=float,
+        default=2.0,
+        help="Seconds between the schedule distribution and the synchronized start of the workers."
+    )
+    parser.add_argument(
+        "--clock_sync_rounds",
+        type=int,
+        default=8,
+        help="Number of ping-pong exchanges used to estimate the clock offset of each worker."
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
 
     main(args)
@@ -0,0 +1,89 @@
+import torch
+import transformers
+from packaging import version
+from transformers import StoppingCriteria
+from transformers.generation.logits_process import LogitsProcessor
+
+
+# Stop strings are matched on token ids. The same string may be tokenized
+# differently depending on the text before it (e.g. the SentencePiece prefix
+# space of Llama turns "\n\n\n\n" into [29871, 13, 13, 13, 13] at the start of
+# a text but [13, 13, 13, 13] after a word), so every stop string is also
+# encoded after a few prefixes and each distinct tokenization is a pattern.
+VARIANT_PREFIXES = ['a', ' ', '.', '\n']
+# Stopping criteria return one flag per sequence since transformers 4.39,
+# older versions force EOS through a logits processor instead.
+PER_SEQUENCE_STOPPING = version.parse(transformers.__version__) >= version.parse('4.39.0')
+
+
+def parse_stop_strings(stops):
+    # Command line values may use escapes such as `\n`. Non-ASCII characters
+    # are turned into escapes first, so only the backslash escapes are decoded.
+    return [stop.encode('latin-1', 'backslashreplace').decode('unicode_escape') for stop in stops]
+
+
+def build_stop_patterns(tokenizer, stop_strings):
+    patterns = []
+    for stop in stop_strings:
+        candidates = [tokenizer.encode(stop, add_special_tokens=False)]
+        for prefix in VARIANT_PREFIXES:
+            prefix_ids = tokenizer.encode(prefix, add_special_tokens=False)
+            ids = tokenizer.encode(prefix + stop, add_special_tokens=False)
+            if ids[:len(prefix_ids)] == prefix_ids:
+                candidates.append(ids[len(prefix_ids):])
+        for ids in candidates:
+            if ids and ids not in patterns and stop in tokenizer.decode(ids):
+                patterns.append(ids)
+    return patterns
+
+
+class StopSequenceMatcher:
+    # Patterns of the same length are stacked, so every length is checked
+    # against the whole batch with a single comparison.
+    def __init__(self, patterns):
+        self.groups = {}
+        for pattern in patterns:
+            self.groups.setdefault(len(pattern), []).append(pattern)
+        self.groups = {length: torch.tensor(group) for length, group in self.groups.items()}
+
+    def __call__(self, input_ids):
+        matched = torch.zeros(input_ids.size(0), dtype=torch.bool, device=input_ids.device)
+        for length, patterns in self.groups.items():
+            if input_ids.size(1) >= length:
+                if patterns.device != input_ids.device:
+                    patterns = self.groups[length] = patterns.to(input_ids.device)
+                matched |= (input_ids[:, None, -length:] == patterns[None]).all(dim=-1).any(dim=-1)
+        return matched
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    # Finished sequences are padded by `generate`, which returns as soon as
+    # every sequence of the batch is finished.
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.reset(0)
+
+    def reset(self, prompt_length):
+        self.prompt_length = prompt_length
+        # Number of new tokens, stop sequence included, when each sequence stopped.
+        self.stop_length = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        matched = self.matcher(input_ids)
+        if self.stop_length is None:
+            self.stop_length = torch.full_like(matched, -1, dtype=torch.long)
+        self.stop_length[matched & (self.stop_length < 0)] = input_ids.size(1) - self.prompt_length
+        return matched
+
+
+class StopSequenceLogitsProcessor(LogitsProcessor):
+    # Fallback of StopSequenceCriteria for transformers < 4.39: EOS is forced
+    # right after a stop sequence.
+    def __init__(self, matcher, eos_token_id):
+        self.matcher = matcher
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        mask = self.matcher(input_ids)
+        scores[mask, self.eos_token_id] = 1e5
+        return scores
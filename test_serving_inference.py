@@ -0,0 +1,62 @@
+import argparse
+import json
+
+import pytest
+
+import serving_inference
+
+
+class WhitespaceTokenizer:
+    # One token per word, plus a BOS token when special tokens are added.
+    def __call__(self, texts, add_special_tokens=True):
+        def encode(text):
+            return (['<s>'] if add_special_tokens else []) + text.split()
+        if isinstance(texts, str):
+            return {'input_ids': encode(texts)}
+        return {'input_ids': [encode(text) for text in texts]}
+
+    def decode(self, input_ids):
+        return ' '.join(input_ids)
+
+
+def make_args(tmp_path, eval_data, **kwargs):
+    data_path = tmp_path / 'data.json'
+    data_path.write_text(json.dumps(eval_data))
+    args = dict(
+        data_path=str(data_path),
+        model_name_or_path='tokenizer',
+        max_tokens_policy='fixed',
+        max_new_tokens=16,
+        max_context_len=None,
+        min_new_tokens=1,
+        truncation_side='left',
+        seed=0,
+    )
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_prompt_is_truncated_to_the_context(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    eval_data = [{'prompt': ' '.join(f'w{i}' for i in range(10))}]
+    args = make_args(tmp_path, eval_data, max_new_tokens=20, max_context_len=25)
+    serving_inference.apply_length_policy(eval_data, WhitespaceTokenizer(), args)
+    assert eval_data[0]['prompt'] == 'w6 w7 w8 w9'
+    assert eval_data[0]['max_tokens'] == 20
+
+
+def test_max_tokens_filling_the_context_is_rejected(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    eval_data = [{'prompt': ' '.join(f'w{i}' for i in range(10))}]
+    args = make_args(tmp_path, eval_data, max_new_tokens=30, max_context_len=30)
+    with pytest.raises(ValueError, match='leaves no room for the prompt'):
+        serving_inference.apply_length_policy(eval_data, WhitespaceTokenizer(), args)
+
+
+def test_beam_search_requires_several_beams():
+    parser = serving_inference.get_parser()
+    args = parser.parse_args(['--backend', 'vllm', '--use_beam_search'])
+    with pytest.raises(ValueError, match='Beam search requires'):
+        serving_inference.check_sampling_args(args)
+    serving_inference.check_sampling_args(parser.parse_args(['--backend', 'vllm', '--use_beam_search', '--best_of', '4']))
+    serving_inference.check_sampling_args(parser.parse_args(['--backend', 'vllm', '--use_beam_search', '--n', '2']))